@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-import sys
+import sys, re
+from array import array
 
 # zen2han(s): Converts every zenkaku letters to ascii ones.
 FULLWIDTH = (
@@ -20,6 +21,8 @@ def zen2han(s):
 ##
 class Mora(object):
 
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
         return
@@ -34,6 +37,12 @@ class TransTable(object):
 
     def __init__(self):
         self._tree = {}
+        # values: every distinct value in the order added. parse_ids()
+        # returns indices of this list.
+        self.values = []
+        self._ids = {}
+        self._rank = {}
+        self._regex = None
         return
     
     def add(self, k, value):
@@ -46,9 +55,87 @@ class TransTable(object):
                 t = t[c]
         assert None not in t, (k, t)
         t[None] = value
+        for c in k:
+            if c not in self._rank:
+                self._rank[c] = len(self._rank)
+        if id(value) not in self._ids:
+            self._ids[id(value)] = len(self.values)
+            self.values.append(value)
+        self._regex = None
+        return
+
+    # compile: turn the tree into one regexp that matches, at each
+    # position, the longest path of the tree as parse_slow() walks it.
+    # Each node becomes an optional group of its children, so the
+    # match stops where the walk would. After a 'qq' node the walk
+    # backs up one character; that is a lookahead that stops before
+    # its last character. The value of a match is then found from
+    # its text with _pathid, or _backup for the lookaheads.
+    # Children without children of their own go in one character
+    # class; the others are tried in the order they were added.
+    def compile(self):
+        self._pathid = {}
+        self._backup = {}
+        self._slowpaths = set()
+        def node(t, path):
+            alts = []
+            leaves = u''
+            for c in sorted(( c for c in t if c is not None ), key=self._rank.get):
+                u = t[c]
+                kids = u''.join( re.escape(x) for x in sorted( x for x in u if x is not None ) )
+                self._pathid[path+c] = self._ids[id(u[None])] if None in u else -1
+                if None in u and u[None].name == 'qq':
+                    self._backup.setdefault(path, {})[c] = self._ids[id(u[None])]
+                    self._slowpaths.add(path)
+                    self._slowpaths.add(path+c)
+                    if kids:
+                        alts.append(u'(?=%s[^%s])' % (re.escape(c), kids))
+                    else:
+                        alts.append(u'(?=%s.)' % re.escape(c))
+                if kids or path+c in self._slowpaths:
+                    alts.append(re.escape(c) + node(u, path+c))
+                else:
+                    leaves += re.escape(c)
+            if None not in t:
+                self._slowpaths.add(path)
+            if leaves:
+                alts.insert(0, u'[%s]' % leaves)
+            if not alts: return u''
+            if not path: return u'(?:%s)' % u'|'.join(alts)
+            return u'(?:%s)?' % u'|'.join(alts)
+        self._regex = re.compile(node(self._tree, u''), re.DOTALL | re.UNICODE)
+        if len(self.values) < 256:
+            self._typecode = 'B'
+        else:
+            self._typecode = 'H'
         return
 
+    # parse_ids: returns the indices of the values in s as an array.
+    # A match is looked up by its text alone unless it has no value
+    # or might have backed up; then each match is checked in turn.
+    def parse_ids(self, s):
+        if self._regex is None:
+            self.compile()
+        paths = self._regex.findall(s)
+        if self._slowpaths.isdisjoint(paths):
+            return array(self._typecode, map(self._pathid.__getitem__, paths))
+        (pathid, backup) = (self._pathid, self._backup)
+        ids = array(self._typecode)
+        for m in self._regex.finditer(s):
+            p = m.group()
+            v = pathid[p]
+            if p in backup:
+                v = backup[p].get(s[m.end():m.end()+1], v)
+            if 0 <= v:
+                ids.append(v)
+        return ids
+
     def parse(self, s):
+        values = self.values
+        return [ values[i] for i in self.parse_ids(s) ]
+
+    # parse_slow: walks the tree one character at a time.
+    def parse_slow(self, s):
         t = self._tree
         r = []
         i = 0
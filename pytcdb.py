@@ -6,14 +6,43 @@
 #   * public domain *
 # 
 
-import sys, os
-from struct import pack, unpack
+import sys, os, re, mmap, threading, heapq, marshal, tempfile
+from struct import pack, unpack, unpack_from, calcsize
 from array import array
+try:
+  import numpy
+except ImportError:
+  numpy = None
 
 
 # calc hash value with a given key
-def cdbhash(s, n=0L):
-  return reduce(lambda h,c: ((h*33) ^ ord(c)) & 0xffffffffL, s, n+5381L)
+def cdbhash(s, n=0):
+  h = (n+5381) & 0xffffffff
+  for c in bytearray(s):
+    h = ((h*33) ^ c) & 0xffffffff
+  return h
+
+# calc hash values of many keys at once (with numpy if available)
+def cdbhash_many(keys, parents=None):
+  if parents is None:
+    parents = [0] * len(keys)
+  if numpy is None or len(keys) < 64:
+    return [ cdbhash(k, n) for (k,n) in zip(keys, parents) ]
+  # hash every group of keys of the same length column by column.
+  r = [None] * len(keys)
+  groups = {}
+  for (i,k) in enumerate(keys):
+    groups.setdefault(len(k), []).append(i)
+  for (klen, idx) in groups.iteritems():
+    h = (numpy.array([ parents[i] for i in idx ], dtype=numpy.uint64) + 5381) & 0xffffffff
+    if klen:
+      a = numpy.frombuffer(''.join( keys[i] for i in idx ), dtype=numpy.uint8)
+      a = a.reshape(len(idx), klen)
+      for j in xrange(klen):
+        h = ((h*33) ^ a[:,j]) & 0xffffffff
+    for (i,x) in zip(idx, h.tolist()):
+      r[i] = x
+  return r
 
 if pack('=i',1) == pack('>i',1):
   # big endian
@@ -33,8 +62,379 @@ else:
     return a.tostring()
 
 
+##  LRUCache
+##
+##  A bounded cache for looked-up values. Either the number of entries
+##  (maxsize) or the total length of keys and values (maxbytes) can be
+##  capped. Entries not used recently are evicted first, as picked by
+##  CLOCK: a hit only marks the entry as used, and a hand goes round
+##  the entries, evicting the first one that was not used since it
+##  last passed. This keeps a hit as cheap as a dict lookup.
+##
+def cachesize(k, v):
+  if isinstance(k, tuple): k = k[-1]
+  if isinstance(v, tuple): v = v[0]
+  return len(k)+len(v)
+
+class LRUCache:
+
+  def __init__(self, maxsize=65536, maxbytes=None, sizeof=cachesize):
+    self.maxsize = maxsize
+    self.maxbytes = maxbytes
+    self.sizeof = sizeof
+    self.nbytes = 0
+    self._dict = {}
+    # _ring: the keys in the order the hand visits them.
+    # _used: the keys used since the hand last passed them.
+    self._ring = []
+    self._used = set()
+    self._hand = 0
+    self.reset()
+    return
+
+  def __len__(self):
+    return len(self._dict)
+
+  def __repr__(self):
+    return ('<%s: entries=%d, bytes=%d, hits=%d, misses=%d, evictions=%d>' %
+            (self.__class__.__name__, len(self._dict), self.nbytes,
+             self.hits, self.misses, self.evictions))
+
+  def reset(self):
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    return
+
+  def clear(self):
+    self._dict.clear()
+    self._ring = []
+    self._used.clear()
+    self._hand = 0
+    self.nbytes = 0
+    return
+
+  def hitrate(self):
+    n = self.hits+self.misses
+    if n == 0: return 0.0
+    return self.hits/float(n)
+
+  def get(self, k):
+    try:
+      v = self._dict[k]
+    except KeyError:
+      self.misses += 1
+      return None
+    self._used.add(k)
+    self.hits += 1
+    return v
+
+  def put(self, k, v):
+    size = 0
+    if self.maxbytes is not None:
+      size = self.sizeof(k, v)
+    if k in self._dict:
+      if self.maxbytes is not None:
+        self.nbytes -= self.sizeof(k, self._dict[k])
+      self.nbytes += size
+      self._dict[k] = v
+      self._used.add(k)
+      while self._dict and self.maxbytes is not None and self.maxbytes < self.nbytes:
+        self._evict()
+      return
+    # a value that can never fit is not kept.
+    if ((self.maxsize is not None and self.maxsize < 1) or
+        (self.maxbytes is not None and self.maxbytes < size)):
+      return
+    while self._dict and ((self.maxsize is not None and self.maxsize <= len(self._dict)) or
+                          (self.maxbytes is not None and self.maxbytes < self.nbytes+size)):
+      self._evict()
+    self.nbytes += size
+    self._dict[k] = v
+    self._ring.append(k)
+    return
+
+  def _evict(self):
+    (ring, used) = (self._ring, self._used)
+    i = self._hand
+    while 1:
+      if len(ring) <= i: i = 0
+      k = ring[i]
+      if k not in used: break
+      used.remove(k)
+      i += 1
+    # the last key fills the hole. It is marked as used so that being
+    # moved ahead of its turn does not get it evicted early.
+    last = ring.pop()
+    if i < len(ring):
+      ring[i] = last
+      used.add(last)
+    self._hand = i
+    v = self._dict.pop(k)
+    if self.maxbytes is not None:
+      self.nbytes -= self.sizeof(k, v)
+    self.evictions += 1
+    return
+
+
+##  StripedCache
+##
+##  A thread-safe cache made of several independently locked caches,
+##  so that threads looking up different keys rarely wait on each other.
+##  The limits (maxsize, maxbytes) are for the whole cache and are
+##  split among the stripes.
+##
+def _split_limit(n, nstripes):
+  if n is None: return None
+  return (n+nstripes-1) // nstripes
+
+class StripedCache:
+
+  def __init__(self, nstripes=16, factory=LRUCache, maxsize=65536, maxbytes=None, **kwargs):
+    maxsize = _split_limit(maxsize, nstripes)
+    maxbytes = _split_limit(maxbytes, nstripes)
+    self._stripes = [ (threading.Lock(), factory(maxsize=maxsize, maxbytes=maxbytes, **kwargs))
+                      for _ in xrange(nstripes) ]
+    return
+
+  nbytes = property(lambda self: sum( c.nbytes for (_,c) in self._stripes ))
+
+  def __len__(self):
+    return sum( len(c) for (_,c) in self._stripes )
+
+  def __repr__(self):
+    return ('<StripedCache: stripes=%d, entries=%d, hits=%d, misses=%d, evictions=%d>' %
+            (len(self._stripes), len(self), self.hits, self.misses, self.evictions))
+
+  hits = property(lambda self: sum( c.hits for (_,c) in self._stripes ))
+  misses = property(lambda self: sum( c.misses for (_,c) in self._stripes ))
+  evictions = property(lambda self: sum( c.evictions for (_,c) in self._stripes ))
+
+  def reset(self):
+    for (lock,c) in self._stripes:
+      with lock:
+        c.reset()
+    return
+
+  def clear(self):
+    for (lock,c) in self._stripes:
+      with lock:
+        c.clear()
+    return
+
+  def hitrate(self):
+    n = self.hits+self.misses
+    if n == 0: return 0.0
+    return self.hits/float(n)
+
+  def get(self, k):
+    (lock,c) = self._stripes[hash(k) % len(self._stripes)]
+    with lock:
+      return c.get(k)
+
+  def put(self, k, v):
+    (lock,c) = self._stripes[hash(k) % len(self._stripes)]
+    with lock:
+      c.put(k, v)
+    return
+
+
+##  BloomFilter
+##
+##  A Bloom filter over the 32-bit hashes stored in a (t)cdb, kept as a
+##  sidecar file so that most lookups of missing keys are answered
+##  without probing the hash table. It is blocked: a hash selects one
+##  byte and sets nhashes bits within it, so a test is a single index
+##  and mask operation. The stamp of the database (see _stamp) is
+##  kept with it, and a filter made from another file is refused.
+##
+##  File layout: 'BLM2', nbytes, nhashes ('<I' each), the stamp,
+##  then the bytes.
+##
+class BloomFilter:
+
+  def __init__(self, nbytes, nhashes=3, bits=None, stamp=None):
+    self.nbytes = max(1, nbytes)
+    self.nhashes = nhashes
+    self.stamp = stamp
+    if bits is None:
+      bits = bytearray(self.nbytes)
+    self._bits = bits
+    # a mask with nhashes bits for each 9-bit value taken from the hash.
+    self._masks = []
+    for x in xrange(512):
+      m = 0
+      for i in xrange(nhashes):
+        m |= 1 << ((x >> (i*3)) & 7)
+      self._masks.append(m)
+    return
+
+  def __repr__(self):
+    return '<BloomFilter: nbytes=%d, nhashes=%d>' % (self.nbytes, self.nhashes)
+
+  def add(self, h):
+    self._bits[(h * 0x9e3779b1 & 0xffffffff) % self.nbytes] |= self._masks[h >> 23]
+    return
+
+  def __contains__(self, h):
+    m = self._masks[h >> 23]
+    return self._bits[(h * 0x9e3779b1 & 0xffffffff) % self.nbytes] & m == m
+
+  @classmethod
+  def fromhashes(klass, hs, bitsperkey=16, stamp=None):
+    bloom = klass((len(hs)*bitsperkey+7)/8, stamp=stamp)
+    for h in hs:
+      bloom.add(h)
+    return bloom
+
+  @classmethod
+  def load(klass, bloomname, stamp=None):
+    fp = file(bloomname, 'rb')
+    (magic, nbytes, nhashes) = unpack('<4sII', fp.read(12))
+    if magic != 'BLM2': raise ValueError('not a bloom filter: %r' % bloomname)
+    stamp1 = fp.read(24)
+    if stamp is not None and stamp1 != stamp:
+      raise ValueError('bloom filter made from another file: %r' % bloomname)
+    bits = bytearray(fp.read(nbytes))
+    fp.close()
+    return klass(nbytes, nhashes, bits, stamp1)
+
+  def save(self, bloomname):
+    assert self.stamp is not None
+    fp = file(bloomname+'.tmp', 'wb')
+    fp.write(pack('<4sII', 'BLM2', self.nbytes, self.nhashes))
+    fp.write(self.stamp)
+    fp.write(str(self._bits))
+    fp.close()
+    os.rename(bloomname+'.tmp', bloomname)
+    return
+
+
+##  ReaderStats
+##
+##  Counters of a reader: lookups asked for, lookups ruled out by the
+##  Bloom filter, hash table cells probed, and reads of the file with
+##  the bytes they returned (accesses to a mapping are not reads).
+##  The hit rate is that of the reader's cache. The counters are not
+##  locked, so they are approximate when shared by threads.
+##
+class ReaderStats:
+
+  def __init__(self, cache=None):
+    self.cache = cache
+    self.reset()
+    return
+
+  def __repr__(self):
+    return ('<ReaderStats: lookups=%d, filtered=%d, probes=%d, reads=%d, bytes=%d, hitrate=%.3f>' %
+            (self.lookups, self.filtered, self.probes, self.reads, self.nbytes, self.hitrate()))
+
+  def reset(self):
+    self.lookups = 0
+    self.filtered = 0
+    self.probes = 0
+    self.reads = 0
+    self.nbytes = 0
+    if self.cache is not None:
+      self.cache.reset()
+    return
+
+  def hitrate(self):
+    if self.cache is None: return 0.0
+    return self.cache.hitrate()
+
+  # perlookup: returns the average (probes, reads, bytes) of a lookup.
+  def perlookup(self):
+    n = float(max(1, self.lookups))
+    return (self.probes/n, self.reads/n, self.nbytes/n)
+
+
 ##  CDB
 ##
+##  The classic layout starts with 256 (pos,ncells) pairs locating the
+##  bucket tables, then the records from offset 2048, then the bucket
+##  tables. Its first word, the position of the first table, is never
+##  less than 2048.
+##
+##  The extended layout starts with a zero word instead, followed by
+##    magic 'cdb2', flags '<I', nbuckets '<I', eod '<Q', hdrpos '<Q'
+##  where nbuckets is a power of two and the nbuckets (pos,ncells)
+##  pairs are stored at hdrpos, after the bucket tables. The records
+##  still start at 2048 and end at eod.
+##
+##  A key with hash h is in bucket h & (nbuckets-1); its probing
+##  starts at cell (h >> log2(nbuckets)) % ncells of that table.
+##
+##  With the CDBWIDE flag, every position is 64-bit: the cells are
+##  (h,poslo,poshi) and the pairs at hdrpos are (poslo,poshi,ncells),
+##  all '<I'. The makers use it for files past 4GiB.
+##
+
+CDBMAGIC = 'cdb2'
+CDBWIDE = 1
+# CDBRECWINDOW: bytes read past a record header at once; most
+# records fit so a lookup takes a single read.
+CDBRECWINDOW = 256
+
+# _posarray: an array that can hold positions past 4GiB.
+def _posarray(a=()):
+  if array('L').itemsize == 8: return array('L', a)
+  return list(a)
+
+# _decodecells: decode bucket tables into interleaved (h,pos).
+def _decodecells(x, wide=0):
+  a = decode(x)
+  if not wide: return a
+  r = [0] * (len(a)/3*2)
+  r[0::2] = a[0::3]
+  r[1::2] = [ lo | hi << 32 for (lo,hi) in zip(a[1::3], a[2::3]) ]
+  return _posarray(r)
+
+# _parseheader: returns (eod, hdrpos, nbuckets, flags) from the first
+# 32 bytes of a file. hdrpos is 0 for the classic layout.
+def _parseheader(x):
+  (eod,) = unpack_from('<I', x)
+  if eod: return (eod, 0, 256, 0)
+  (magic, flags, nbuckets, eod, hdrpos) = unpack_from('<4sIIQQ', x, 4)
+  if magic != CDBMAGIC: raise ValueError('unknown format: %r' % magic)
+  return (eod, hdrpos, nbuckets, flags)
+
+# _readheader: returns the header and the (pos,ncells) pairs.
+def _readheader(read):
+  (eod, hdrpos, nbuckets, flags) = _parseheader(read(0, 32))
+  if flags & CDBWIDE:
+    a = decode(read(hdrpos, nbuckets*12))
+    hash0 = [ (a[i] | a[i+1] << 32, a[i+2]) for i in xrange(0, nbuckets*3, 3) ]
+  else:
+    a = decode(read(hdrpos, nbuckets*8))
+    hash0 = [ (a[i], a[i+1]) for i in xrange(0, nbuckets*2, 2) ]
+  return (eod, hdrpos, nbuckets, flags, hash0)
+
+# _readcells: returns the whole hash region of a file as an array
+# of interleaved (h,pos).
+def _readcells(fp):
+  fp.seek(0)
+  (eod, hdrpos, nbuckets, flags) = _parseheader(fp.read(32))
+  fp.seek(eod)
+  if hdrpos: return _decodecells(fp.read(hdrpos-eod), flags & CDBWIDE)
+  return decode(fp.read())
+
+# _nbuckets: the number of buckets for n entries. Keeps about 1024
+# entries (16KB) per bucket table, and the classic 256 buckets for
+# up to 256K entries.
+def _nbuckets(n):
+  nbuckets = 256
+  while nbuckets < 65536 and nbuckets*1024 < n:
+    nbuckets *= 2
+  return nbuckets
+
+def _log2(n):
+  return len(bin(n))-3
+
+# _stamp: ties a sidecar file to the database it was made from:
+# its end of data, header position and number of entries.
+def _stamp(eod, hdrpos, nentries):
+  return pack('<QQQ', eod, hdrpos, nentries)
 
 # cdbiter
 def cdbiter(fp, eod):
@@ -53,15 +453,52 @@ def cdbiter(fp, eod):
 # CDBReader
 class CDBReader:
   
-  def __init__(self, cdbname, docache=1):
+  def __init__(self, cdbname, docache=1, usemmap=0, cache=None, preload=0,
+               threadsafe=0, bloomname=None):
     self.name = cdbname
     self._fp = file(cdbname, 'rb')
-    hash0 = decode(self._fp.read(2048))
-    self._hash0 = [ (hash0[i], hash0[i+1]) for i in xrange(0, 512, 2) ]
-    self._hash1 = [ None ] * 256
-    (self._eod,_) = self._hash0[0]
-    self._docache = docache
-    self._cache = {}
+    self.stats = ReaderStats()
+    # threadsafe: never touch the shared file position, so that one
+    # instance can serve many threads. Reads through the read-only
+    # mapping.
+    self._read = self._fileread
+    if threadsafe:
+      usemmap = 1
+    # usemmap: decode everything straight from a shared read-only mapping.
+    self._map = None
+    if usemmap:
+      self._map = mmap.mmap(self._fp.fileno(), 0, access=mmap.ACCESS_READ)
+      self._read = self._mapread
+    (self._eod, self._hdrpos, self._nbuckets, flags, self._hash0) = _readheader(self._read)
+    # every entry takes two cells of the hash table.
+    self.stamp = _stamp(self._eod, self._hdrpos, sum( n for (_,n) in self._hash0 )/2)
+    self._hash1 = [ None ] * self._nbuckets
+    self._mask = self._nbuckets-1
+    self._shift = _log2(self._nbuckets)
+    # wide: 64-bit positions. The bucket tables are decoded into
+    # (h,pos) pairs when loaded, so lookups go through them.
+    self._wide = flags & CDBWIDE
+    self._cellsize = 12 if self._wide else 8
+    self._find = self._filefind
+    if self._map is not None and not self._wide:
+      self._find = self._mapfind
+    elif preload:
+      # keep the whole bucket index resident from the start.
+      self._preload()
+    # cache: any object with get(k)/put(k,v); docache=0 disables caching.
+    if cache is None and docache:
+      if threadsafe:
+        cache = StripedCache()
+      else:
+        cache = LRUCache()
+    self._cache = cache
+    self.stats.cache = cache
+    # bloomname: sidecar made by cdbbloom() or the makers from this
+    # very file (ValueError otherwise); keys it rules out are
+    # reported missing without probing.
+    self._bloom = None
+    if bloomname is not None:
+      self._bloom = BloomFilter.load(bloomname, self.stamp)
     self._keyiter = None
     self._eachiter = None
     return
@@ -74,33 +511,151 @@ class CDBReader:
 
   def __getitem__(self, k):
     k = str(k)
-    if k in self._cache: return self._cache[k]
+    self.stats.lookups += 1
+    if self._cache is not None:
+      v1 = self._cache.get(k)
+      if v1 is not None: return v1
     h = cdbhash(k)
-    h1 = h & 0xff
-    (pos_bucket, ncells) = self._hash0[h1]
-    if ncells == 0: raise KeyError(k)
+    if self._bloom is not None and h not in self._bloom:
+      self.stats.filtered += 1
+      raise KeyError(k)
+    (v1,_) = self._find(k, h)
+    if self._cache is not None:
+      self._cache.put(k, v1)
+    return v1
+
+  def get_many(self, keys, failed=None):
+    keys = [ str(k) for k in keys ]
+    self.stats.lookups += len(keys)
+    r = [failed] * len(keys)
+    todo = []
+    for (i,k) in enumerate(keys):
+      v1 = None
+      if self._cache is not None:
+        v1 = self._cache.get(k)
+      if v1 is None:
+        todo.append(i)
+      else:
+        r[i] = v1
+    hs = cdbhash_many([ keys[i] for i in todo ])
+    reqs = [ (i, keys[i], h) for (i,h) in zip(todo, hs) ]
+    for (i, k, (v1,_)) in self._findmany(reqs):
+      if self._cache is not None:
+        self._cache.put(k, v1)
+      r[i] = v1
+    return r
+
+  def _fileread(self, pos, n):
+    self.stats.reads += 1
+    self.stats.nbytes += n
+    self._fp.seek(pos)
+    return self._fp.read(n)
+
+  def _mapread(self, pos, n):
+    return self._map[pos:pos+n]
+
+  def _bucket(self, h1):
     hs = self._hash1[h1]
-    if hs == None:
-      self._fp.seek(pos_bucket)
-      hs = decode(self._fp.read(ncells * 8))
+    if hs is None:
+      (pos_bucket, ncells) = self._hash0[h1]
+      hs = _decodecells(self._read(pos_bucket, ncells * self._cellsize), self._wide)
       self._hash1[h1] = hs
-    i = ((h >> 8) % ncells) * 2
+    return hs
+
+  def _preload(self):
+    # load the whole hash region with one read and split it per bucket.
+    (pos_end, ncells) = self._hash0[-1]
+    pos_end += ncells * self._cellsize
+    a = _decodecells(self._read(self._eod, pos_end - self._eod), self._wide)
+    for (h1, (pos_bucket, ncells)) in enumerate(self._hash0):
+      i = (pos_bucket - self._eod) / self._cellsize * 2
+      self._hash1[h1] = a[i:i+ncells*2]
+    return
+
+  def _filefind(self, k, h):
+    h1 = h & self._mask
+    ncells = self._hash0[h1][1]
+    if ncells == 0: raise KeyError(k)
+    hs = self._bucket(h1)
+    i = ((h >> self._shift) % ncells) * 2
     n = ncells*2
+    st = self.stats
     for _ in xrange(ncells):
+      st.probes += 1
       p1 = hs[i+1]
       if p1 == 0: raise KeyError(k)
       if hs[i] == h:
-        self._fp.seek(p1)
-        (klen, vlen) = unpack('<II', self._fp.read(8))
-        k1 = self._fp.read(klen)
-        if k1 == k:
-          v1 = self._fp.read(vlen)
-          if self._docache:
-            self._cache[k] = v1
-          return v1
+        # the header, the key and usually the value in one read.
+        x = self._read(p1, 8+len(k)+CDBRECWINDOW)
+        (klen, vlen) = unpack_from('<II', x)
+        if klen == len(k) and x[8:8+klen] == k:
+          e = 8+klen+vlen
+          if len(x) < e:
+            x += self._read(p1+len(x), e-len(x))
+          return (x[8+klen:e], p1)
       i = (i+2) % n
     raise KeyError(k)
 
+  def _findmany(self, reqs):
+    # reqs: a list of (i,k,h). Buckets are visited in order, then
+    # every candidate record is read in file order. Yields (i,k,(v,p))
+    # for each key found.
+    (mask, shift) = (self._mask, self._shift)
+    st = self.stats
+    cands = []
+    for (i,k,h) in sorted(reqs, key=lambda (i,k,h): h & mask):
+      if self._bloom is not None and h not in self._bloom:
+        st.filtered += 1
+        continue
+      h1 = h & mask
+      ncells = self._hash0[h1][1]
+      if ncells == 0: continue
+      hs = self._bucket(h1)
+      j = ((h >> shift) % ncells) * 2
+      n = ncells*2
+      for rank in xrange(ncells):
+        st.probes += 1
+        p1 = hs[j+1]
+        if p1 == 0: break
+        if hs[j] == h:
+          cands.append((p1, rank, i, k))
+        j = (j+2) % n
+    cands.sort()
+    found = {}
+    for (p1, rank, i, k) in cands:
+      (k1, v1) = self._readrec(p1)
+      if k1 == k and (i not in found or rank < found[i][0]):
+        found[i] = (rank, k, (v1,p1))
+    for (i, (_, k, r)) in found.iteritems():
+      yield (i, k, r)
+    return
+
+  def _readrec(self, p1):
+    x = self._read(p1, 8+CDBRECWINDOW)
+    (klen, vlen) = unpack_from('<II', x)
+    e = 8+klen+vlen
+    if len(x) < e:
+      x += self._read(p1+len(x), e-len(x))
+    return (x[8:8+klen], x[8+klen:e])
+
+  def _mapfind(self, k, h):
+    m = self._map
+    (pos_bucket, ncells) = self._hash0[h & self._mask]
+    if ncells == 0: raise KeyError(k)
+    start = (h >> self._shift) % ncells
+    st = self.stats
+    for i in xrange(ncells):
+      st.probes += 1
+      (h1, p1) = unpack_from('<II', m, pos_bucket + ((start+i) % ncells << 3))
+      if p1 == 0: raise KeyError(k)
+      if h1 == h:
+        (klen, vlen) = unpack_from('<II', m, p1)
+        p = p1+8
+        if m[p:p+klen] == k:
+          p += klen
+          return (m[p:p+vlen], p1)
+    raise KeyError(k)
+
   def get(self, k, failed=None):
     try:
       return self.__getitem__(k)
@@ -145,16 +700,91 @@ class CDBReader:
     return cdbiter(self._fp, self._eod)
 
 
+# celltable: build the hash table of one bucket from its interleaved
+# (h,p) pairs and return it encoded. Entries are placed in order of
+# their home cell (stable, so the first of duplicate keys is probed
+# first), which lets each cell be computed as a running maximum
+# instead of probing: cell[j] = max(home[j], cell[j-1]+1).
+def celltable(b1, shift=8, wide=0):
+  w = 3 if wide else 2                  # words per cell
+  ncells = len(b1)
+  hs = b1[0::2]
+  ps = b1[1::2]
+  if numpy is not None:
+    h = numpy.array(hs, dtype=numpy.uint32)
+    p = numpy.array(ps, dtype=numpy.uint64)
+    home = (h >> shift) % ncells
+    order = numpy.argsort(home, kind='mergesort')
+    j = numpy.arange(len(order))
+    cell = numpy.maximum.accumulate(home[order].astype(numpy.int64) - j) + j
+    a = numpy.zeros(ncells*w, dtype='<u4')
+    ok = cell < ncells
+    (c, src) = (cell[ok]*w, order[ok])
+    a[c] = h[src]
+    a[c+1] = p[src] & 0xffffffff
+    if wide:
+      a[c+2] = p[src] >> 32
+    wrapped = order[~ok].tolist()
+    a = array('I', a.tostring())
+    if pack('=i',1) == pack('>i',1): a.byteswap()
+  else:
+    home = [ (h >> shift) % ncells for h in hs ]
+    order = sorted(xrange(len(hs)), key=home.__getitem__)
+    a = array('I', [0]) * (ncells*w)
+    i = -1
+    wrapped = []
+    for j in order:
+      i = max(home[j], i+1)
+      if ncells <= i:
+        wrapped.append(j)
+        continue
+      a[i*w] = hs[j]
+      a[i*w+1] = ps[j] & 0xffffffff
+      if wide:
+        a[i*w+2] = ps[j] >> 32
+  # entries running past the end continue from the first cell.
+  i = 0
+  for j in wrapped:
+    while a[i*w+1] or a[i*w+w-1]:       # is cell[i] already occupied?
+      i += 1
+    a[i*w] = hs[j]
+    a[i*w+1] = ps[j] & 0xffffffff
+    if wide:
+      a[i*w+2] = ps[j] >> 32
+  return encode(a)
+
+def _celltable(args):
+  return celltable(*args)
+
+
 # CDBMaker
 class CDBMaker:
 
-  def __init__(self, cdbname, tmpname):
+  def __init__(self, cdbname, tmpname, bufsize=1024*1024, nprocs=1,
+               bloomname=None, nbuckets=None, wide=None):
     self.fn = cdbname
     self.fntmp = tmpname
     self.numentries = 0
+    self.bufsize = bufsize
+    # bloomname: also write a Bloom filter of the hashes at finish().
+    self.bloomname = bloomname
+    # nbuckets: number of top-level buckets, a power of two not less
+    # than 256. Chosen from the number of entries if not given; 256
+    # writes the classic layout.
+    self.nbuckets = nbuckets
+    # wide: write 64-bit positions. Chosen from the size of the file
+    # if not given.
+    self.wide = wide
+    # nprocs: parse, hash and build bucket tables in worker processes.
+    self.nprocs = nprocs
+    self._pool = None
     self._fp = file(tmpname, 'wb')
     self._pos = 2048                    # sizeof((h,p))*256
+    self._fp.seek(self._pos)
+    self._buf = []
+    self._buflen = 0
     self._bucket = [ array('I') for _ in xrange(256) ]
+    self._wide = False                  # any position past 4GiB?
     return
 
   def __len__(self):
@@ -166,98 +796,293 @@ class CDBMaker:
   def __setstate__(self, dict):
     raise TypeError
 
+  # append a record to the buffer and return its position.
+  def _write(self, k, v):
+    pos = self._pos
+    (klen, vlen) = (len(k), len(v))
+    self._buf.append(pack('<II', klen, vlen))
+    self._buf.append(k)
+    self._buf.append(v)
+    # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
+    self._pos += 8+klen+vlen
+    self._buflen += 8+klen+vlen
+    if 0xffffffff < self._pos and not self._wide:
+      self._widen()
+    if self.bufsize <= self._buflen:
+      self._flush()
+    return pos
+
+  def _flush(self):
+    self._fp.write(''.join(self._buf))
+    self._buf = []
+    self._buflen = 0
+    return
+
   def add(self, k, v):
     (k, v) = (str(k), str(v))
-    (klen, vlen) = (len(k), len(v))
-    self._fp.seek(self._pos)
-    self._fp.write(pack('<II', klen, vlen))
-    self._fp.write(k)
-    self._fp.write(v)
+    pos = self._write(k, v)
     h = cdbhash(k)
     b = self._bucket[h % 256]
     b.append(h)
-    b.append(self._pos)
-    # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
-    self._pos += 8+klen+vlen
+    b.append(pos)
     self.numentries += 1
     return self
-  
+
+  def add_many(self, items):
+    items = [ (str(k), str(v)) for (k,v) in items ]
+    return self._append(items, cdbhash_many([ k for (k,_) in items ]))
+
+  # append records whose hashes are already computed.
+  def _append(self, items, hs):
+    (buf, bucket, pos, pos0) = (self._buf, self._bucket, self._pos, self._pos)
+    wide = self._wide
+    for ((k,v),h) in zip(items, hs):
+      if 0xffffffff < pos and not wide:
+        bucket = self._widen()
+        wide = True
+      (klen, vlen) = (len(k), len(v))
+      buf.append(pack('<II', klen, vlen))
+      buf.append(k)
+      buf.append(v)
+      b = bucket[h % 256]
+      b.append(h)
+      b.append(pos)
+      pos += 8+klen+vlen
+    self._pos = pos
+    self._buflen += pos-pos0
+    if self.bufsize <= self._buflen:
+      self._flush()
+    self.numentries += len(items)
+    return self
+
+  # _widen: make the buckets hold positions past 4GiB.
+  def _widen(self):
+    self._bucket = [ _posarray(b1) for b1 in self._bucket ]
+    self._wide = True
+    return self._bucket
+
+  def _getpool(self):
+    if self._pool is None:
+      import multiprocessing
+      self._pool = multiprocessing.Pool(self.nprocs)
+    return self._pool
+
+  def _closepool(self):
+    if self._pool is not None:
+      self._pool.close()
+      self._pool.join()
+      self._pool = None
+    return
+
+  # _split: redistribute the 256 buckets filled by add() into
+  # nbuckets by more bits of the hash, keeping the order of entries.
+  def _split(self, nbuckets):
+    if nbuckets == 256: return self._bucket
+    if nbuckets < 256 or nbuckets & (nbuckets-1):
+      raise ValueError('invalid number of buckets: %r' % nbuckets)
+    mask = nbuckets-1
+    if self._wide:
+      bucket = [ _posarray() for _ in xrange(nbuckets) ]
+    else:
+      bucket = [ array('I') for _ in xrange(nbuckets) ]
+    for b in self._bucket:
+      for i in xrange(0, len(b), 2):
+        h = b[i]
+        b1 = bucket[h & mask]
+        b1.append(h)
+        b1.append(b[i+1])
+    self._bucket = bucket
+    return bucket
+
   def finish(self):
-    self._fp.seek(self._pos)
-    pos_hash = self._pos
+    self._flush()
+    pos_hash = eod = self._pos
+    nbuckets = self.nbuckets or _nbuckets(self.numentries)
+    shift = _log2(nbuckets)
+    wide = self.wide
+    if wide is None:
+      wide = 0xffffffff < eod + self.numentries*16 + nbuckets*8
+    cellsize = 12 if wide else 8
     # write hashes
-    for b1 in self._bucket:
-      if not b1: continue
-      blen = len(b1)
-      a = array('I', [0]*blen*2)
-      for j in xrange(0, blen, 2):
-        (h,p) = (b1[j],b1[j+1])
-        i = ((h >> 8) % blen)*2
-        while a[i+1]:             # is cell[i] already occupied?
-          i = (i+2) % len(a)
-        a[i] = h
-        a[i+1] = p
-      self._fp.write(encode(a))
+    buckets = [ (b1, shift, wide) for b1 in self._split(nbuckets) if b1 ]
+    if 1 < self.nprocs:
+      tables = self._getpool().imap(_celltable, buckets)
+    else:
+      tables = ( celltable(*args) for args in buckets )
+    for a in tables:
+      self._fp.write(a)
+    self._closepool()
     # write header
-    self._fp.seek(0)
     a = array('I')
     for b1 in self._bucket:
-      a.append(pos_hash)
+      if wide:
+        a.append(pos_hash & 0xffffffff)
+        a.append(pos_hash >> 32)
+      else:
+        a.append(pos_hash)
       a.append(len(b1))
-      pos_hash += len(b1)*8
-    self._fp.write(encode(a))
+      pos_hash += len(b1)*cellsize
+    if nbuckets == 256 and not wide:
+      hdrpos = 0
+      self._fp.seek(0)
+      self._fp.write(encode(a))
+    else:
+      hdrpos = pos_hash
+      self._fp.write(encode(a))
+      self._fp.seek(0)
+      flags = CDBWIDE if wide else 0
+      self._fp.write(pack('<I4sIIQQ', 0, CDBMAGIC, flags, nbuckets, eod, pos_hash))
     # close
     self._fp.close()
     os.rename(self.fntmp, self.fn)
+    if self.bloomname is not None:
+      hs = []
+      for b1 in self._bucket:
+        hs.extend(b1[0::2])
+      stamp = _stamp(eod, hdrpos, len(hs))
+      BloomFilter.fromhashes(hs, stamp=stamp).save(self.bloomname)
     return
 
   # txt2cdb
   def txt2cdb(self, lines):
-    import re
-    HEAD = re.compile(r'^\+(\d+),(\d+):')
-    for line in lines:
-      m = HEAD.match(line)
-      if not m: break
-      (klen, vlen) = (int(m.group(1)), int(m.group(2)))
-      i = len(m.group(0))
-      k = line[i:i+klen]
-      i += klen
-      if line[i:i+2] != '->': raise ValueError('invalid separator: %r' % line)
-      i += 2
-      v = line[i:i+vlen]
-      self.add(k, v)
+    if 1 < self.nprocs:
+      results = self._getpool().imap(_parsehashcdb, _chunks(lines))
+    else:
+      results = ( _parsehashcdb(chunk) for chunk in _chunks(lines) )
+    for (items, hs, ended) in results:
+      self._append(items, hs)
+      if ended: break
     return self
 
 
+# _chunks: split lines into lists of n lines.
+def _chunks(lines, n=4096):
+  chunk = []
+  for line in lines:
+    chunk.append(line)
+    if n <= len(chunk):
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+  return
+
+# _parsecdb: parse lines of '+klen,vlen:k->v' up to the first line
+# that is not a record. Returns (items, ended).
+CDBHEAD = re.compile(r'^\+(\d+),(\d+):')
+def _parsecdb(lines):
+  items = []
+  for line in lines:
+    m = CDBHEAD.match(line)
+    if not m: return (items, True)
+    (klen, vlen) = m.group(1, 2)
+    i = m.end()
+    j = i+int(klen)
+    if line[j:j+2] != '->': raise ValueError('invalid separator: %r' % line)
+    items.append((line[i:j], line[j+2:j+2+int(vlen)]))
+  return (items, False)
+
+def _parsehashcdb(lines):
+  (items, ended) = _parsecdb(lines)
+  return (items, cdbhash_many([ k for (k,_) in items ]), ended)
+
+# _parsetcdb: parse lines of '++klen,vlen:k->v'. Returns (items, ended).
+TCDBHEAD = re.compile(r'^(\++)(\d+),(\d+):')
+def _parsetcdb(lines):
+  items = []
+  for line in lines:
+    m = TCDBHEAD.match(line)
+    if not m: return (items, True)
+    (depth, klen, vlen) = m.group(1, 2, 3)
+    i = m.end()
+    j = i+int(klen)
+    if line[j:j+2] != '->': raise ValueError('invalid separator: %r' % line)
+    items.append((len(depth), line[i:j], line[j+2:j+2+int(vlen)]))
+  return (items, False)
+
+def _hashmany(args):
+  return cdbhash_many(*args)
+
+
 # cdbdump
 def cdbdump(cdbname):
   fp = file(cdbname, 'rb')
-  (eor,) = unpack('<I', fp.read(4))
+  (eor,_,_,_) = _parseheader(fp.read(32))
   return cdbiter(fp, eor)
 
 
-# cdbmerge
+# cdbsort: sort (k,v) pairs in bounded memory. Whenever the
+# buffered pairs exceed maxbytes they are sorted and spilled to a
+# temporary file; the sorted runs are then merged. maxbytes counts
+# the Python objects held, not just the strings. At most maxruns
+# runs (each an open file) are kept: beyond that they are merged
+# into one first.
+def cdbsort(it, maxbytes=64*1024*1024, maxruns=64):
+  getsizeof = sys.getsizeof
+  def recsize(k, v):
+    # the pair, its slot in the list, the key and the value.
+    n = getsizeof((k,v)) + 8 + getsizeof(k) + getsizeof(v)
+    if isinstance(k, tuple):
+      n += sum( getsizeof(x) for x in k )
+    return n
+  def spill(recs):
+    fp = tempfile.TemporaryFile()
+    for x in recs:
+      marshal.dump(x, fp)
+    fp.seek(0)
+    return fp
+  def load(fp):
+    try:
+      while 1:
+        yield marshal.load(fp)
+    except EOFError:
+      pass
+    fp.close()
+    return
+  runs = []
+  buf = []
+  size = 0
+  for (k,v) in it:
+    buf.append((k,v))
+    size += recsize(k, v)
+    if maxbytes <= size:
+      buf.sort()
+      if maxruns <= len(runs)+1:
+        runs = [load(spill(heapq.merge(*runs)))]
+      runs.append(load(spill(buf)))
+      buf = []
+      size = 0
+  buf.sort()
+  if not runs:
+    return iter(buf)
+  runs.append(iter(buf))
+  return heapq.merge(*runs)
+
+
+# cdbmerge: merge sorted iterators of (k,v) into (k,[v,...]).
 def cdbmerge(iters):
   q = []
-  for it in iters:
+  for (i,it) in enumerate(iters):
     try:
-      q.append((it.next(),it))
+      (k,v) = it.next()
+      q.append((k,v,i,it))
     except StopIteration:
       pass
+  heapq.heapify(q)
   k0 = None
   vs = None
   while q:
-    q.sort()
-    ((k,v),it) = q.pop(0)
+    (k,v,i,it) = q[0]
     if k0 != k:
       if vs: yield (k0,vs)
       vs = []
     vs.append(v)
     k0 = k
     try:
-      q.append((it.next(),it))
+      (k,v) = it.next()
+      heapq.heapreplace(q, (k,v,i,it))
     except StopIteration:
-      continue
+      heapq.heappop(q)
   if vs: yield (k0,vs)
   return
 
@@ -272,13 +1097,11 @@ init = CDBReader
 
 # tcdbiter
 def tcdbiter(fp, eor):
+  a = _readcells(fp)
   locs = {}
-  fp.seek(eor)
-  while 1:
-    x = fp.read(8)
-    if not x: break
-    (h, pos) = unpack('<II', x)
-    if pos: locs[pos] = h
+  for i in xrange(0, len(a), 2):
+    if a[i+1]: locs[a[i+1]] = a[i]
+  del a
   pos = 2048
   fp.seek(pos)
   key = ()
@@ -301,59 +1124,150 @@ def tcdbiter(fp, eor):
   return
 
 
+# tcdbiter_compact: same as tcdbiter, but instead of loading every
+# (hash,pos) pair first, it checks each candidate parent by probing
+# the hash table through a mapping of the file. Memory stays
+# proportional to the depth of the tree.
+def tcdbiter_compact(fp, eor):
+  m = mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ)
+  (_, _, nbuckets, flags, hash0) = _readheader(lambda pos,n: m[pos:pos+n])
+  (mask, shift) = (nbuckets-1, _log2(nbuckets))
+  wide = flags & CDBWIDE
+  def stored(h, pos):
+    (pos_bucket, ncells) = hash0[h & mask]
+    if ncells == 0: return False
+    i = (h >> shift) % ncells
+    for _ in xrange(ncells):
+      if wide:
+        (h1, lo, hi) = unpack_from('<III', m, pos_bucket + i*12)
+        p1 = lo | hi << 32
+      else:
+        (h1, p1) = unpack_from('<II', m, pos_bucket + (i << 3))
+      if p1 == 0: return False
+      if h1 == h and p1 == pos: return True
+      i = (i+1) % ncells
+    return False
+  pos = 2048
+  key = ()
+  parents = [0]
+  while pos < eor:
+    (klen, vlen) = unpack_from('<II', m, pos)
+    k = m[pos+8:pos+8+klen]
+    v = m[pos+8+klen:pos+8+klen+vlen]
+    # the parent is usually the nearest one, so try the deepest first.
+    for i in xrange(len(parents)-1, -1, -1):
+      if stored(cdbhash(k, parents[i]), pos):
+        parents = parents[:i+1]
+        key = key[:i]
+        break
+    key += (k,)
+    yield (key, v)
+    parents.append(pos)
+    pos += 8+klen+vlen
+  m.close()
+  fp.close()
+  return
+
+
 # TCDBMaker
 class TCDBMaker(CDBMaker):
 
-  def __init__(self, cdbname, tmpname):
-    CDBMaker.__init__(self, cdbname, tmpname)
+  def __init__(self, cdbname, tmpname, bufsize=1024*1024, nprocs=1,
+               bloomname=None, nbuckets=None, wide=None):
+    CDBMaker.__init__(self, cdbname, tmpname, bufsize=bufsize, nprocs=nprocs,
+                      bloomname=bloomname, nbuckets=nbuckets, wide=wide)
     self._parent = 0
     self._stack = [self._parent]
     return
 
-  def put(self, depth, k, v):
+  def _push(self, depth):
     if depth == len(self._stack)+1:
       self._stack.append(self._parent)
     elif depth < len(self._stack):
       self._stack = self._stack[:depth]
     elif depth != len(self._stack):
       raise ValueError('invalid depth: %d' % depth)
-    #
+    return self._stack[-1]
+
+  def put(self, depth, k, v):
+    parent = self._push(depth)
     (k, v) = (str(k), str(v))
-    (klen, vlen) = (len(k), len(v))
-    self._parent = self._pos
-    # sizeof(keylen)+sizeof(datalen)+sizeof(key)+sizeof(data)
-    self._fp.seek(self._pos)
-    self._fp.write(pack('<II', klen, vlen))
-    self._fp.write(k)
-    self._fp.write(v)
-    self._pos += 4+4+klen+vlen
-    h = cdbhash(k, self._stack[-1])
+    self._parent = self._write(k, v)
+    h = cdbhash(k, parent)
     b = self._bucket[h % 256]
     b.append(h)
     b.append(self._parent)
     self.numentries += 1
     return self
 
+  def put_many(self, items):
+    items = [ (depth, str(k), str(v)) for (depth,k,v) in items ]
+    (keys, parents, poss) = self._place(items)
+    self._index(cdbhash_many(keys, parents), poss)
+    return self
+
+  # write records and return their keys, parents and positions.
+  # the hashes are computed separately and given to _index().
+  def _place(self, items):
+    (keys, parents, poss) = ([], [], [])
+    for (depth,k,v) in items:
+      keys.append(k)
+      parents.append(self._push(depth))
+      self._parent = self._write(k, v)
+      poss.append(self._parent)
+    self.numentries += len(items)
+    return (keys, parents, poss)
+
+  def _index(self, hs, poss):
+    bucket = self._bucket
+    for (h,pos) in zip(hs, poss):
+      b = bucket[h % 256]
+      b.append(h)
+      b.append(pos)
+    return
+
   def txt2tcdb(self, lines):
-    import re
-    HEAD = re.compile(r'^(\++)(\d+),(\d+):')
-    for line in lines:
-      m = HEAD.match(line)
-      if not m: break
-      (depth, klen, vlen) = (len(m.group(1)), int(m.group(2)), int(m.group(3)))
-      i = len(m.group(0))
-      k = line[i:i+klen]
-      i += klen
-      if line[i:i+2] != '->': raise ValueError('invalid separator: %r' % line)
-      i += 2
-      v = line[i:i+vlen]
-      self.put(depth, k, v)
+    if self.nprocs <= 1:
+      for chunk in _chunks(lines):
+        (items, ended) = _parsetcdb(chunk)
+        self.put_many(items)
+        if ended: break
+      return self
+    # parents depend on the positions of all preceding records, so
+    # records are placed here in order and only parsing and hashing
+    # are done by the workers.
+    pool = self._getpool()
+    pending = []
+    for (items, ended) in pool.imap(_parsetcdb, _chunks(lines)):
+      (keys, parents, poss) = self._place(items)
+      pending.append((pool.apply_async(_hashmany, ((keys, parents),)), poss))
+      while pending and (pending[0][0].ready() or self.nprocs*2 < len(pending)):
+        (r, poss) = pending.pop(0)
+        self._index(r.get(), poss)
+      if ended: break
+    for (r, poss) in pending:
+      self._index(r.get(), poss)
     return self
 
 
 # TCDBReader
 class TCDBReader(CDBReader):
 
+  def __init__(self, cdbname, docache=1, usemmap=0, cache=None, preload=0,
+               threadsafe=0, bloomname=None, kidsname=None):
+    CDBReader.__init__(self, cdbname, docache=docache, usemmap=usemmap,
+                       cache=cache, preload=preload, threadsafe=threadsafe,
+                       bloomname=bloomname)
+    # kidsname: sidecar index made by tcdbkids() that lists the
+    # children of every node in one record. It is not used if it was
+    # made from another file.
+    self._kids = None
+    if kidsname is not None:
+      self._kids = CDBReader(kidsname, usemmap=usemmap, threadsafe=threadsafe)
+      if self._kids.get('') != self.stamp:
+        self._kids = None
+    return
+
   def lookup(self, seq, parent=0L):
     r = []
     for k in seq:
@@ -363,69 +1277,474 @@ class TCDBReader(CDBReader):
 
   def lookup1(self, k, parent=0L):
     k = str(k)
-    if self._docache and (parent,k) in self._cache:
-      return self._cache[(parent,k)]
+    self.stats.lookups += 1
+    if self._cache is not None:
+      r = self._cache.get((parent,k))
+      if r is not None: return r
     h = cdbhash(k, parent)
-    self._fp.seek((h % 256) << 3)
-    (pos_bucket, ncells) = unpack('<II', self._fp.read(8))
-    if ncells == 0: raise KeyError(k)
-    start = (h >> 8) % ncells
-    for i in xrange(ncells):
-      self._fp.seek(pos_bucket + ((start+i) % ncells << 3))
-      (h1, p1) = unpack('<II', self._fp.read(8))
-      if p1 == 0: raise KeyError(k)
-      if h1 == h:
-        self._fp.seek(p1)
-        (klen, vlen) = unpack('<II', self._fp.read(8))
-        k1 = self._fp.read(klen)
-        if k1 == k:
-          v1 = self._fp.read(vlen)
-          if self._docache:
-            self._cache[(parent,k)] = (v1,p1)
-          return (v1,p1)
-    raise KeyError(k)
+    if self._bloom is not None and h not in self._bloom:
+      self.stats.filtered += 1
+      raise KeyError(k)
+    r = self._find(k, h)
+    if self._cache is not None:
+      self._cache.put((parent,k), r)
+    return r
 
-  def iterkeys(self):
-    return ( k for (k,v) in tcdbiter(self._fp, self._eod) )
-  def itervalues(self):
-    return ( v for (k,v) in tcdbiter(self._fp, self._eod) )
-  def iteritems(self):
+  def lookup_many(self, pairs, failed=None):
+    # pairs: a list of (parent,k). Returns (v,pos) or failed for each.
+    pairs = [ (parent, str(k)) for (parent,k) in pairs ]
+    self.stats.lookups += len(pairs)
+    r = [failed] * len(pairs)
+    todo = []
+    for (i,pk) in enumerate(pairs):
+      v1 = None
+      if self._cache is not None:
+        v1 = self._cache.get(pk)
+      if v1 is None:
+        todo.append(i)
+      else:
+        r[i] = v1
+    hs = cdbhash_many([ pairs[i][1] for i in todo ], [ pairs[i][0] for i in todo ])
+    reqs = [ (i, pairs[i][1], h) for (i,h) in zip(todo, hs) ]
+    for (i, k, v1) in self._findmany(reqs):
+      if self._cache is not None:
+        self._cache.put(pairs[i], v1)
+      r[i] = v1
+    return r
+
+  # children: returns [(k,v,pos), ...] of the given node in file order.
+  def children(self, parent=0):
+    if self._kids is None:
+      return [ (k,v,pos) for (depth,k,v,pos) in self._walk(parent) if depth == 1 ]
+    (keyfmt, kidfmt) = _kidformats(self._wide)
+    x = self._kids.get(pack(keyfmt, parent), '')
+    r = []
+    i = 0
+    n = calcsize(kidfmt)
+    while i < len(x):
+      (pos, klen, vlen) = unpack_from(kidfmt, x, i)
+      i += n
+      r.append((x[i:i+klen], x[i+klen:i+klen+vlen], pos))
+      i += klen+vlen
+    return r
+
+  # prefix_scan: yields (key,v,pos) of every node below the given one
+  # in file order, where key is the path relative to that node.
+  def prefix_scan(self, parent=0):
+    if self._kids is None:
+      key = ()
+      for (depth,k,v,pos) in self._walk(parent):
+        key = key[:depth-1]+(k,)
+        yield (key, v, pos)
+      return
+    stack = [ ((k,), v, pos) for (k,v,pos) in reversed(self.children(parent)) ]
+    while stack:
+      (key, v, pos) = stack.pop()
+      yield (key, v, pos)
+      stack.extend( (key+(k,), v1, p1) for (k,v1,p1) in reversed(self.children(pos)) )
+    return
+
+  # _stored: True if the hash table has the cell (h,pos).
+  def _stored(self, h, pos):
+    h1 = h & self._mask
+    ncells = self._hash0[h1][1]
+    if ncells == 0: return False
+    hs = self._bucket(h1)
+    i = ((h >> self._shift) % ncells) * 2
+    n = ncells*2
+    st = self.stats
+    for _ in xrange(ncells):
+      st.probes += 1
+      p1 = hs[i+1]
+      if p1 == 0: return False
+      if p1 == pos: return hs[i] == h
+      i = (i+2) % n
+    return False
+
+  # _walk: yields (depth,k,v,pos) of the nodes below the given one.
+  # They are stored right after it, so read on until a record whose
+  # parent is not on the current path.
+  def _walk(self, parent=0):
+    pos = 2048
+    if parent:
+      (klen, vlen) = unpack('<II', self._read(parent, 8))
+      pos = parent+8+klen+vlen
+    path = [parent]
+    while pos < self._eod:
+      (klen, vlen) = unpack('<II', self._read(pos, 8))
+      x = self._read(pos+8, klen+vlen)
+      (k, v) = (x[:klen], x[klen:])
+      for i in xrange(len(path)-1, -1, -1):
+        if self._stored(cdbhash(k, path[i]), pos): break
+      else:
+        return
+      del path[i+1:]
+      yield (i+1, k, v, pos)
+      path.append(pos)
+      pos += 8+klen+vlen
+    return
+
+  def iterkeys(self, compact=0):
+    return ( k for (k,v) in self.iteritems(compact) )
+  def itervalues(self, compact=0):
+    return ( v for (k,v) in self.iteritems(compact) )
+  def iteritems(self, compact=0):
+    if compact:
+      return tcdbiter_compact(self._fp, self._eod)
     return tcdbiter(self._fp, self._eod)
 
 
 # tcdbdump
-def tcdbdump(cdbname):
+def tcdbdump(cdbname, compact=0):
   fp = file(cdbname, 'rb')
-  (eor,) = unpack('<I', fp.read(4))
+  (eor,_,_,_) = _parseheader(fp.read(32))
+  if compact:
+    return tcdbiter_compact(fp, eor)
   return tcdbiter(fp, eor)
 
 
+# hashcheck: recompute the hash of every record with both cdbhash and
+# cdbhash_many and compare them with the hashes stored in the file.
+# Returns (number of records, number of mismatches).
+def hashcheck(cdbname, tree=0):
+  fp = file(cdbname, 'rb')
+  (eor,_,_,_) = _parseheader(fp.read(32))
+  a = _readcells(fp)
+  locs = {}
+  for i in xrange(0, len(a), 2):
+    if a[i+1]: locs[a[i+1]] = a[i]
+  (keys, parents, hashes) = ([], [], [])
+  nbad = 0
+  stack = [0]
+  pos = 2048
+  fp.seek(pos)
+  while pos < eor:
+    (klen, vlen) = unpack('<II', fp.read(8))
+    k = fp.read(klen)
+    fp.read(vlen)
+    h = locs.get(pos)
+    parent = 0
+    if tree:
+      # find the parent as tcdbiter does, with the scalar hash.
+      for (i,p) in enumerate(stack):
+        if cdbhash(k, p) == h:
+          parent = p
+          stack = stack[:i+1]
+          break
+      else:
+        nbad += 1
+      stack.append(pos)
+    elif cdbhash(k) != h:
+      nbad += 1
+    keys.append(k)
+    parents.append(parent)
+    hashes.append(h)
+    pos += 8+klen+vlen
+  fp.close()
+  for (h0,h1) in zip(hashes, cdbhash_many(keys, parents)):
+    if h0 != h1: nbad += 1
+  return (len(keys), nbad)
+
+
+# cdbstat: statistics of a cdb/tcdb file, as a dict of
+#   records, nbuckets, wide,
+#   fill: {entries in a bucket: number of buckets},
+#   probes: {cells probed to find an entry: number of entries},
+#   misses: {cells probed for a missing key: number of home cells},
+#   keysizes, valsizes: {length: number of records},
+#   depths: {depth: number of records} (tree only).
+def cdbstat(cdbname, tree=0):
+  def count(d, x):
+    d[x] = d.get(x, 0)+1
+  r = CDBReader(cdbname, docache=0, preload=1)
+  st = dict(records=0, nbuckets=r._nbuckets, wide=bool(r._wide),
+            fill={}, probes={}, misses={}, keysizes={}, valsizes={}, depths={})
+  for (h1, (_, ncells)) in enumerate(r._hash0):
+    if ncells == 0:
+      count(st['fill'], 0)
+      continue
+    hs = r._bucket(h1)
+    occupied = [ bool(hs[c*2+1]) for c in xrange(ncells) ]
+    count(st['fill'], sum(occupied))
+    for c in xrange(ncells):
+      if occupied[c]:
+        count(st['probes'], (c - (hs[c*2] >> r._shift) % ncells) % ncells + 1)
+    # a missing key probes up to the first empty cell from its home.
+    e = occupied.index(False)
+    d = 0
+    for c in xrange(e, e-ncells, -1):
+      d = d+1 if occupied[c] else 1
+      count(st['misses'], d)
+  if tree:
+    for (key, v) in tcdbdump(cdbname, compact=1):
+      count(st['depths'], len(key))
+      count(st['keysizes'], len(key[-1]))
+      count(st['valsizes'], len(v))
+      st['records'] += 1
+  else:
+    for (k, v) in cdbdump(cdbname):
+      count(st['keysizes'], len(k))
+      count(st['valsizes'], len(v))
+      st['records'] += 1
+  return st
+
+
+# tcdbkids: build the sidecar index of children for a tcdb.
+# Each node that has children gets one cdb record keyed by its position
+# (pack('<I',pos), 0 for the root) whose value is the concatenation of
+# pack('<III',pos,klen,vlen)+k+v of the children, in file order.
+# For a tcdb with 64-bit positions they are pack('<Q',pos) and
+# pack('<QII',pos,klen,vlen). The empty key holds the stamp of
+# the tcdb.
+def _kidformats(wide):
+  if wide: return ('<Q', '<QII')
+  return ('<I', '<III')
+
+def tcdbkids(tcdbname, kidsname):
+  r = TCDBReader(tcdbname, docache=0)
+  m = CDBMaker(kidsname, kidsname+'.tmp')
+  (keyfmt, kidfmt) = _kidformats(r._wide)
+  m.add('', r.stamp)
+  # a node's children are complete once the walk leaves its subtree.
+  stack = [(0, [])]
+  for (depth, k, v, pos) in r._walk(0):
+    while depth < len(stack):
+      (p, kids) = stack.pop()
+      if kids: m.add(pack(keyfmt, p), ''.join(kids))
+    stack[-1][1].append(pack(kidfmt, pos, len(k), len(v))+k+v)
+    stack.append((pos, []))
+  while stack:
+    (p, kids) = stack.pop()
+    if kids: m.add(pack(keyfmt, p), ''.join(kids))
+  m.finish()
+  return
+
+
+##  Double-array trie
+##
+##  tcdbcompile() turns a tcdb into a double-array trie held in flat
+##  arrays. Every distinct key gets an integer code (frequent keys get
+##  small ones), so one (parent,k) edge of the tcdb is one transition:
+##  the child of node s by key k is t = base[s]+code[k], valid if
+##  check[t] == s+1. Node 0 is the root; a node is identified by its
+##  index, which DATrieReader.lookup1 returns in place of a position.
+##
+##  File layout (all integers '<I'):
+##    'DAT1', nsyms, nvals, nnodes,
+##    symbol lengths[nsyms], value lengths[nvals],
+##    base[nnodes], check[nnodes], vidx[nnodes],
+##    symbol bytes, value bytes.
+##
+
+# tcdbcompile
+def tcdbcompile(tcdbname, datname):
+  # read the tree: kids[node] = [(k,v,node), ...]
+  # Of children with the same key, lookup1 only finds the first in
+  # file order, so the others are left out along with their subtrees.
+  kids = [[]]
+  path = [0]
+  freq = {}
+  edges = set()
+  for (key, v) in tcdbdump(tcdbname):
+    k = key[-1]
+    del path[len(key):]
+    if path[-1] is None or (path[-1], k) in edges:
+      path.append(None)
+      continue
+    edges.add((path[-1], k))
+    kids[path[-1]].append((k, v, len(kids)))
+    path.append(len(kids))
+    kids.append([])
+    freq[k] = freq.get(k, 0)+1
+  syms = sorted(freq, key=lambda k: (-freq[k], k))
+  code = dict( (k,i+1) for (i,k) in enumerate(syms) )
+  vals = []
+  vindex = {}
+  # place the children of every node, breadth first, at the lowest
+  # base where all their cells are free. Nodes with several children
+  # start looking from `start`, which moves forward whenever a search
+  # had to skip over a crowded region.
+  base = array('I', [0])
+  check = array('I', [0])
+  vidx = array('I', [0])
+  used = bytearray('\x01')
+  firstfree = 1
+  start = 1
+  queue = [(0, 0)]
+  for (node, s) in queue:
+    if not kids[node]: continue
+    cs = sorted( (code[k],k,v,child) for (k,v,child) in kids[node] )
+    c0 = cs[0][0]
+    if len(cs) == 1:
+      t0 = max(firstfree, c0)
+    else:
+      t0 = max(firstfree, start, c0)
+    ntries = 0
+    while 1:
+      t0 = used.find('\x00', t0)
+      if t0 < 0: t0 = len(used)
+      b = t0-c0
+      for (c,_,_,_) in cs:
+        if b+c < len(used) and used[b+c]: break
+      else:
+        break
+      t0 += 1
+      ntries += 1
+    if 128 < ntries:
+      start = t0
+    n = b+cs[-1][0]+1
+    if len(used) < n:
+      used.extend('\x00' * (n-len(used)))
+      for a in (base, check, vidx):
+        a.extend([0] * (n-len(a)))
+    base[s] = b
+    for (c,k,v,child) in cs:
+      t = b+c
+      used[t] = 1
+      check[t] = s+1
+      if v not in vindex:
+        vindex[v] = len(vals)
+        vals.append(v)
+      vidx[t] = vindex[v]
+      queue.append((child, t))
+    while firstfree < len(used) and used[firstfree]:
+      firstfree += 1
+  fp = file(datname+'.tmp', 'wb')
+  fp.write(pack('<4sIII', 'DAT1', len(syms), len(vals), len(base)))
+  fp.write(encode(array('I', [ len(k) for k in syms ])))
+  fp.write(encode(array('I', [ len(v) for v in vals ])))
+  for a in (base, check, vidx):
+    fp.write(encode(a))
+  fp.write(''.join(syms))
+  fp.write(''.join(vals))
+  fp.close()
+  os.rename(datname+'.tmp', datname)
+  return
+
+
+# DATrieReader: reads a file made by tcdbcompile() with the same
+# lookup()/lookup1() interface as TCDBReader.
+class DATrieReader:
+
+  def __init__(self, datname):
+    self.name = datname
+    fp = file(datname, 'rb')
+    (magic, nsyms, nvals, nnodes) = unpack('<4sIII', fp.read(16))
+    if magic != 'DAT1': raise ValueError('not a compiled trie: %r' % datname)
+    symlens = decode(fp.read(nsyms*4))
+    vallens = decode(fp.read(nvals*4))
+    self._base = decode(fp.read(nnodes*4))
+    self._check = decode(fp.read(nnodes*4))
+    self._vidx = decode(fp.read(nnodes*4))
+    self._code = {}
+    for (i,n) in enumerate(symlens):
+      self._code[fp.read(n)] = i+1
+    self._vals = [ fp.read(n) for n in vallens ]
+    fp.close()
+    return
+
+  def __len__(self):
+    return len(self._check)
+
+  def lookup(self, seq, parent=0):
+    r = []
+    for k in seq:
+      (v, parent) = self.lookup1(k, parent)
+      r.append(v)
+    return r
+
+  def lookup1(self, k, parent=0):
+    c = self._code.get(k)
+    if c is not None:
+      t = self._base[parent]+c
+      if t < len(self._check) and self._check[t] == parent+1:
+        return (self._vals[self._vidx[t]], t)
+    raise KeyError(k)
+
+
+# cdbbloom: build the Bloom filter sidecar of an existing cdb/tcdb
+# from the hashes stored in its hash region.
+def cdbbloom(cdbname, bloomname, bitsperkey=16):
+  stamp = CDBReader(cdbname, docache=0).stamp
+  fp = file(cdbname, 'rb')
+  a = _readcells(fp)
+  fp.close()
+  hs = [ a[i] for i in xrange(0, len(a), 2) if a[i+1] ]
+  BloomFilter.fromhashes(hs, bitsperkey, stamp).save(bloomname)
+  return
+
+
 # aliases
 tcdbmake = TCDBMaker
 tcdbinit = TCDBReader
 tcdbmerge = cdbmerge
 
 
+# printstat: print the result of cdbstat().
+# Sizes are shown in bins of powers of two.
+def printstat(name, st, out=sys.stdout):
+  def hist(title, d, binned=0):
+    n = sum(d.itervalues())
+    if not n: return
+    avg = sum( x*c for (x,c) in d.iteritems() ) / float(n)
+    print >>out, '%s: min %d, avg %.2f, max %d' % (title, min(d), avg, max(d))
+    if binned:
+      bins = {}
+      for (x,c) in d.iteritems():
+        b = _log2(x)+1 if x else 0
+        bins[b] = bins.get(b, 0)+c
+      labels = dict( (b, '%d-%d' % (2**(b-1), 2**b-1)) for b in bins if 1 < b )
+      labels[0] = '0'
+      labels[1] = '1'
+      d = bins
+    else:
+      labels = dict( (x, str(x)) for x in d )
+    for x in sorted(d):
+      print >>out, '  %12s: %8d %5.1f%%' % (labels[x], d[x], d[x]*100.0/n)
+    return
+  print >>out, '%s: %d records, %d buckets%s' % (name, st['records'], st['nbuckets'],
+                                                 ', 64-bit' if st['wide'] else '')
+  hist('entries per bucket', st['fill'])
+  hist('probes per hit', st['probes'], binned=1)
+  hist('probes per miss', st['misses'], binned=1)
+  hist('depth', st['depths'])
+  hist('key size', st['keysizes'], binned=1)
+  hist('value size', st['valsizes'], binned=1)
+  return
+
+
 # main
 def main(argv):
   import getopt, fileinput
   def usage():
-    print 'usage: %s {cmake,cget,cdump,cmerge} [options] cdbname [args ...]' % argv[0]
-    print 'usage: %s {tmake,tget,tdump,tmerge} [options] tcdbname [args ...]' % argv[0]
+    print 'usage: %s {cmake,cget,cdump,cmerge,ccheck,cbloom,cstat} [options] cdbname [args ...]' % argv[0]
+    print 'usage: %s {tmake,tget,tdump,tmerge,tcheck,tkids,tscan,tcompile,tbloom,tstat} [options] tcdbname [args ...]' % argv[0]
     return 100
   args = argv[1:]
   if not args: return usage()
   cmd = args.pop(0)
   try:
-    (opts, args) = getopt.getopt(args, 'kv2')
+    (opts, args) = getopt.getopt(args, 'kv2cm:j:b:B:')
   except getopt.GetoptError:
     return usage()
   if not args: return usage()
   dbname = args.pop(0)
+  maxbytes = 64*1024*1024
+  nprocs = 1
+  compact = 0
+  nbuckets = None
+  bloomname = None
+  for (k, v) in opts:
+    if k == '-m': maxbytes = int(v)
+    elif k == '-j': nprocs = int(v)
+    elif k == '-c': compact = 1
+    elif k == '-b': nbuckets = int(v)
+    elif k == '-B': bloomname = v
   
   # cdb
   if cmd == 'cmake':
-    CDBMaker(dbname, dbname+'.tmp').txt2cdb(fileinput.input(args)).finish()
+    CDBMaker(dbname, dbname+'.tmp', nprocs=nprocs, nbuckets=nbuckets,
+             bloomname=bloomname).txt2cdb(fileinput.input(args)).finish()
   elif cmd == 'cget':
     print repr(CDBReader(dbname).get(args[0]))
   elif cmd == 'cdump':
@@ -438,14 +1757,23 @@ def main(argv):
       print f(k,v)
     print
   elif cmd == 'cmerge':
-    dbs = [ cdbdump(fname) for fname in args ]
+    dbs = [ cdbsort(cdbdump(fname), maxbytes/len(args)) for fname in args ]
     m = CDBMaker(dbname, dbname+'.tmp')
     for (k,vs) in tcdbmerge(dbs):
       m.add(k, ' '.join(vs))
     m.finish()
+  elif cmd == 'cbloom':
+    cdbbloom(dbname, (args or [dbname+'.bloom'])[0])
+  elif cmd == 'ccheck':
+    (n, nbad) = hashcheck(dbname)
+    print '%s: %d records, %d hash mismatches' % (dbname, n, nbad)
+    if nbad: return 1
+  elif cmd in ('cstat', 'tstat'):
+    printstat(dbname, cdbstat(dbname, tree=(cmd == 'tstat')))
   # tcdb
   elif cmd == 'tmake':
-    TCDBMaker(dbname, dbname+'.tmp').txt2tcdb(fileinput.input(args)).finish()
+    TCDBMaker(dbname, dbname+'.tmp', nprocs=nprocs, nbuckets=nbuckets,
+              bloomname=bloomname).txt2tcdb(fileinput.input(args)).finish()
   elif cmd == 'tget':
     print repr(TCDBReader(dbname).lookup(args))
   elif cmd == 'tdump':
@@ -454,15 +1782,40 @@ def main(argv):
       if k == '-k': f = (lambda k,_: '/'.join(k))
       elif k == '-v': f = (lambda _,v: v)
       elif k == '-2': f = (lambda k,v: '/'.join(k)+'\t'+v)
-    for (k,v) in tcdbdump(dbname):
+    for (k,v) in tcdbdump(dbname, compact):
       print f(k,v)
     print
   elif cmd == 'tmerge':
-    dbs = [ tcdbdump(fname) for fname in args ]
+    dbs = [ cdbsort(tcdbdump(fname), maxbytes/len(args)) for fname in args ]
     m = TCDBMaker(dbname, dbname+'.tmp')
     for (k,vs) in tcdbmerge(dbs):
       m.put(len(k), k[-1], ' '.join(vs))
     m.finish()
+  elif cmd == 'tkids':
+    tcdbkids(dbname, (args or [dbname+'.kids'])[0])
+  elif cmd == 'tscan':
+    kidsname = dbname+'.kids'
+    if not os.path.exists(kidsname): kidsname = None
+    r = TCDBReader(dbname, kidsname=kidsname)
+    parent = 0
+    for k in args:
+      (_, parent) = r.lookup1(k, parent)
+    f = (lambda k,v: '%s%d,%d:%s->%s' % ('+'*len(k), len(k[-1]), len(v), k[-1], v))
+    for (k, v) in opts:
+      if k == '-k': f = (lambda k,_: '/'.join(k))
+      elif k == '-v': f = (lambda _,v: v)
+      elif k == '-2': f = (lambda k,v: '/'.join(k)+'\t'+v)
+    for (k,v,_) in r.prefix_scan(parent):
+      print f(k,v)
+    print
+  elif cmd == 'tcompile':
+    tcdbcompile(dbname, (args or [os.path.splitext(dbname)[0]+'.dat'])[0])
+  elif cmd == 'tbloom':
+    cdbbloom(dbname, (args or [dbname+'.bloom'])[0])
+  elif cmd == 'tcheck':
+    (n, nbad) = hashcheck(dbname, tree=1)
+    print '%s: %d records, %d hash mismatches' % (dbname, n, nbad)
+    if nbad: return 1
     
   else:
     return usage()
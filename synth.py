@@ -3,10 +3,16 @@
 import sys
 import array
 import struct
+from collections import Counter
+from pytcdb import LRUCache
 from yomi import Wakacher
 from yomi import Yomer
 from mora import MoraTable
 from math import cos, pi
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 def mix(x, y):
     assert len(x) == len(y)
@@ -18,50 +24,232 @@ def mix(x, y):
     return r
 
 
+##  PhoneTable
+##
+##  Maps a sequence of mora IDs to the diphone units to be spoken.
+##  A state is the last sound of the previous mora ('_' is silence);
+##  for each (state, mora) the table has the units to yield and the
+##  next state. The extra mora END closes a word.
+##
+class PhoneTable(object):
+
+    VOWELS = ('aa','ii','uu','ee','oo','nn')
+
+    def __init__(self, names):
+        self.END = len(names)
+        self.nmoras = n = len(names)+1
+        self.states = ['_'] + sorted(set(
+            name[-1] for name in names if name not in ('.', ',', '-', 'q') ))
+        # units: unit names indexed by unit ID. 0 means no unit.
+        self.units = [None]
+        unitid = {}
+        def unit(k):
+            if k not in unitid:
+                unitid[k] = len(self.units)
+                self.units.append(k)
+            return unitid[k]
+        stateid = dict( (k,i) for (i,k) in enumerate(self.states) )
+        size = len(self.states)*n
+        self._unit0 = array.array('H', [0])*size
+        self._unit1 = array.array('H', [0])*size
+        self._next = array.array('B', [0])*size
+        # _mnext: the next state after each mora, or -1 if it stays.
+        self._mnext = [0]*n
+        for (s,k0) in enumerate(self.states):
+            for (m,name) in enumerate(names+[None]):
+                j = s*n+m
+                if name is None:
+                    self._unit0[j] = unit(k0+'_')
+                    k1 = '_'
+                elif name in ('.', ','):
+                    self._unit0[j] = unit(k0+'_')
+                    self._unit1[j] = unit(name)
+                    k1 = '_'
+                elif name == '-':
+                    self._unit1[j] = unit(k0)
+                    k1 = k0
+                    self._mnext[m] = -1
+                elif name == 'q':
+                    self._unit1[j] = unit(k0+name)
+                    k1 = '_'
+                else:
+                    k = k0+name
+                    if k in self.VOWELS:
+                        k = k[0]
+                    self._unit1[j] = unit(k)
+                    k1 = name[-1]
+                self._next[j] = stateid[k1]
+                if name != '-':
+                    self._mnext[m] = stateid[k1]
+        if numpy is not None:
+            self._nunit0 = numpy.array(self._unit0, dtype=numpy.uint16)
+            self._nunit1 = numpy.array(self._unit1, dtype=numpy.uint16)
+            self._nmnext = numpy.array(self._mnext, dtype=numpy.intp)
+        return
+
+    # convert: returns the unit IDs for a sequence of mora IDs,
+    # starting from silence.
+    def convert(self, ids):
+        n = self.nmoras
+        if numpy is None or len(ids) < 64:
+            (unit0, unit1, next) = (self._unit0, self._unit1, self._next)
+            r = array.array('H')
+            s = 0
+            for m in ids:
+                j = s+m
+                if unit0[j]:
+                    r.append(unit0[j])
+                if unit1[j]:
+                    r.append(unit1[j])
+                s = next[j]*n
+            return r
+        # the state before each mora is the one set by the last
+        # mora before it that is not '-'.
+        m = numpy.array(ids, dtype=numpy.intp)
+        nx = self._nmnext[m]
+        i = numpy.maximum.accumulate(numpy.where(0 <= nx, numpy.arange(len(m)), -1))
+        s = numpy.zeros(len(m), dtype=numpy.intp)
+        s[1:] = numpy.where(0 <= i[:-1], nx[i[:-1]], 0)
+        j = s*n+m
+        u = numpy.empty(len(m)*2, dtype=numpy.uint16)
+        u[0::2] = self._nunit0[j]
+        u[1::2] = self._nunit1[j]
+        return array.array('H', u[u != 0].tostring())
+
+
+##  UnitCache
+##
+##  Decoded units of a phone bank within a memory budget (maxbytes).
+##  The budget does not cover a cache of the phone bank itself, so
+##  open it with docache=0; the crossfade widths are kept by the
+##  Synthesizer.
+##  A unit is kept as array('h'), or as a scaled float32 array if
+##  numpy is available, or as is if raw is set. Units not used
+##  recently are evicted first.
+##
+def unitsize(k, v):
+    return len(v)*getattr(v, 'itemsize', 1)
+
+class UnitCache(LRUCache):
+
+    def __init__(self, phonedb, maxbytes=16*1024*1024, ratio=1.0/32768.0, raw=False):
+        LRUCache.__init__(self, maxsize=None, maxbytes=maxbytes, sizeof=unitsize)
+        self.phonedb = phonedb
+        self.ratio = ratio
+        self.raw = raw
+        return
+
+    def decode(self, data):
+        if self.raw:
+            return data
+        if numpy is not None:
+            return numpy.frombuffer(data, dtype='<i2') * numpy.float32(self.ratio)
+        a = array.array('h')
+        a.fromstring(data)
+        return a
+
+    def __getitem__(self, k):
+        a = self.get(k)
+        if a is None:
+            a = self.decode(self.phonedb[k])
+            self.put(k, a)
+        return a
+
+    # preload: decode the most frequent of the given unit names
+    # while they fit in the budget.
+    def preload(self, keys):
+        for (k,_) in Counter(keys).most_common():
+            try:
+                a = self.decode(self.phonedb[k])
+            except KeyError:
+                continue
+            if self.maxbytes < self.nbytes+unitsize(k, a): break
+            self.put(k, a)
+        return
+
+
 ##  Synthesizer
 ##
 class Synthesizer(object):
 
     def __init__(self, langdb, phonedb,
-                 dictcodec='euc-jp', framerate=44100, ratio=1.0/32768.0, restdur=200):
+                 dictcodec='euc-jp', framerate=44100, ratio=1.0/32768.0, restdur=200,
+                 cachebytes=16*1024*1024, rawpcm=False):
         self.yomer = Yomer(langdb, dictcodec)
         self.wakacher = Wakacher(langdb, dictcodec)
         self.phonedb = phonedb
         self.framerate = framerate
         self.restframe = framerate*restdur/1000
         self.ratio = ratio
+        # rawpcm: write 16-bit samples with writer.writeraw() and
+        # never turn them into floats.
+        self.rawpcm = rawpcm
+        # units: decoded units of phonedb, up to cachebytes. Its
+        # hits/misses/hitrate() tell how well it does. Any cache of
+        # phonedb itself comes on top of it.
+        self.units = UnitCache(phonedb, cachebytes, ratio, raw=rawpcm)
+        # _windows: crossfade curves by overlap length.
+        self._windows = {}
+        self._qwindows = {}
+        # _widths: crossfade width by pair of units (0 if none).
+        self._widths = {}
+        return
+
+    # set_langdb: switch to another dictionary.
+    def set_langdb(self, langdb):
+        self.yomer.set_tcdb(langdb)
+        self.wakacher.set_tcdb(langdb)
+        return
+
+    # preload: decode the units used most in a sample text ahead.
+    def preload(self, text):
+        self.units.preload(self._genphones(self.wakacher.get_chunks(text)))
         return
 
     def synth(self, writer, text):
-        self.genwave(writer, self._genphones(text))
+        self.genwave(writer, self._genphones(self.wakacher.get_chunks(text)))
         return
 
-    VOWELS = ('aa','ii','uu','ee','oo','nn')
-    def _genphones(self, text):
-        for s in self.wakacher.get_chunks(text):
-            for y in self.yomer.get_yomi(s):
-                for (k,v) in y:
-                    k0 = '_'
-                    for m in MoraTable.parse(v or k):
-                        if m.name in ('.', ','):
-                            yield k0+'_'
-                            k = m.name
-                            k0 = '_'
-                        elif m.name == '-':
-                            k = k0
-                        elif m.name == 'q':
-                            k = k0+m.name
-                            k0 = '_'
-                        else:
-                            k = k0+m.name
-                            k0 = m.name[-1]
-                            if k in self.VOWELS:
-                                k = k[0]
-                        yield k
-                    yield k0+'_'
+    # synth_pieces: synthesize a text given in pieces of any size,
+    # e.g. read from a stream. Each chunk is spoken as soon as it is
+    # complete, so the whole text is never held at once.
+    def synth_pieces(self, writer, pieces):
+        self.genwave(writer, self._genphones(self.wakacher.iter_chunks(pieces)))
+        return
+
+    PHONES = PhoneTable([ m.name for m in MoraTable.values ])
+    def _genphones(self, chunks):
+        phones = self.PHONES
+        units = phones.units
+        for y in self.yomer.iter_yomi(chunks):
+            ids = []
+            for (k,v) in y:
+                ids.extend(MoraTable.parse_ids(v or k))
+                ids.append(phones.END)
+            for u in phones.convert(ids):
+                yield units[u]
         return
 
+    # _width: the crossfade width between two units.
+    def _width(self, k0, k1):
+        try:
+            return self._widths[(k0, k1)]
+        except KeyError:
+            pass
+        w = 0
+        v = self.phonedb.get(k0+'+'+k1)
+        if v is not None:
+            (w,) = struct.unpack('<i', v)
+        self._widths[(k0, k1)] = w
+        return w
+
     def genwave(self, writer, keys):
+        if self.rawpcm:
+            self._genwave_raw(writer, keys)
+            return
+        if numpy is not None:
+            self._genwave_numpy(writer, keys)
+            return
         (f0, w0, k0) = (None, 0, None)
         for k1 in keys:
             if k1 == '.':
@@ -70,17 +258,13 @@ class Synthesizer(object):
                 f1 = [0]*(self.restframe)
             else:
                 try:
-                    data = self.phonedb[k1]
+                    a = self.units[k1]
                 except KeyError:
                     continue
-                a = array.array('h')
-                a.fromstring(data)
                 f1 = [ x*self.ratio for x in a ]
             w1 = 0
             if k0 is not None:
-                k = k0+'+'+k1
-                if k in self.phonedb:
-                    (w1,) = struct.unpack('<i', self.phonedb[k])
+                w1 = self._width(k0, k1)
                 if w1:
                     writer.write(f0[w0:-w1])
                     writer.write(mix(f0[-w1:], f1[:w1]))
@@ -91,10 +275,95 @@ class Synthesizer(object):
             writer.write(f0[w0:])
         return
 
+    # _genwave_numpy: same as genwave but the frames are numpy arrays.
+    def _genwave_numpy(self, writer, keys):
+        (f0, w0, k0) = (None, 0, None)
+        for k1 in keys:
+            if k1 == '.':
+                f1 = numpy.zeros(self.restframe*2, dtype=numpy.float32)
+            elif k1 == ',':
+                f1 = numpy.zeros(self.restframe, dtype=numpy.float32)
+            else:
+                try:
+                    f1 = self.units[k1]
+                except KeyError:
+                    continue
+            w1 = 0
+            if k0 is not None:
+                w1 = self._width(k0, k1)
+                if w1:
+                    writer.write(f0[w0:-w1])
+                    writer.write(self._mix(f0[-w1:], f1[:w1]))
+                else:
+                    writer.write(f0[w0:])
+            (f0,w0,k0) = (f1,w1,k1)
+        if f0 is not None:
+            writer.write(f0[w0:])
+        return
+
+    # _genwave_raw: same as genwave but the frames are 16-bit PCM.
+    # Only the overlaps are decoded; the rest is passed as is, so the
+    # writer has to take 16-bit mono frames.
+    def _genwave_raw(self, writer, keys):
+        assert writer.sampwidth == 2 and writer.nchannels == 1
+        (f0, w0, k0) = (None, 0, None)
+        for k1 in keys:
+            if k1 == '.':
+                f1 = '\0'*(self.restframe*4)
+            elif k1 == ',':
+                f1 = '\0'*(self.restframe*2)
+            else:
+                try:
+                    f1 = self.units[k1]
+                except KeyError:
+                    continue
+            w1 = 0
+            if k0 is not None:
+                w1 = self._width(k0, k1)
+                if w1:
+                    writer.writeraw(f0[w0*2:-w1*2])
+                    writer.writeraw(self._mixraw(f0[-w1*2:], f1[:w1*2]))
+                else:
+                    writer.writeraw(f0[w0*2:])
+            (f0,w0,k0) = (f1,w1,k1)
+        if f0 is not None:
+            writer.writeraw(f0[w0*2:])
+        return
+
+    # _mixraw: mix() for 16-bit PCM, in 15-bit fixed point.
+    def _mixraw(self, x, y):
+        assert len(x) == len(y)
+        n = len(x)/2
+        if n not in self._qwindows:
+            C = pi/n
+            p = [ int((1.0-cos(C*i))*16384.0+0.5) for i in xrange(n) ]
+            if numpy is not None:
+                p = numpy.array(p, dtype=numpy.int32)
+            self._qwindows[n] = p
+        p = self._qwindows[n]
+        if numpy is not None:
+            a = numpy.frombuffer(x, dtype='<i2').astype(numpy.int32)
+            b = numpy.frombuffer(y, dtype='<i2').astype(numpy.int32)
+            return ((a*(32768-p) + b*p) >> 15).astype('<i2').tostring()
+        a = array.array('h', x)
+        b = array.array('h', y)
+        r = array.array('h', [ (s*(32768-q) + t*q) >> 15 for (s,t,q) in zip(a, b, p) ])
+        return r.tostring()
+
+    # _mix: mix() for numpy arrays.
+    def _mix(self, x, y):
+        assert len(x) == len(y)
+        n = len(x)
+        if n not in self._windows:
+            p = (1.0-numpy.cos(numpy.arange(n)*(pi/n)))*0.5
+            self._windows[n] = p.astype(numpy.float32)
+        p = self._windows[n]
+        return (1.0-p)*x + p*y
+
 # main
 def main(argv):
-    import getopt, fileinput, os.path
-    from pytcdb import TCDBReader, CDBReader
+    import getopt, codecs, os
+    from pytcdb import TCDBReader, CDBReader, DATrieReader
     from wavestream import WaveWriter
     from wavestream import PygameWavePlayer as WavePlayer
     def usage():
@@ -116,18 +385,39 @@ def main(argv):
         elif k == '-C': dictcodec = v
         elif k == '-D': dictpath = v
         elif k == '-o': output = v
-    langdb = TCDBReader(dictpath)
-    phonedb = CDBReader(phonepath)
-    synth = Synthesizer(langdb, phonedb, dictcodec=dictcodec)
+    if dictpath.endswith('.dat'):
+        langdb = DATrieReader(dictpath)
+    else:
+        langdb = TCDBReader(dictpath)
+    # the units are cached by the synthesizer.
+    phonedb = CDBReader(phonepath, docache=0)
+    synth = Synthesizer(langdb, phonedb, dictcodec=dictcodec, rawpcm=True)
     if output is None:
         writer = WavePlayer()
     else:
         fp = open(output, 'wb')
         writer = WaveWriter(fp)
-    for line in fileinput.input(args):
-        line = line.decode(codec, 'ignore')
-        synth.synth(writer, line)
+    # read the input in pieces so that speech starts right away
+    # even without a newline in sight.
+    def pieces(bufsize=4096):
+        decoder = codecs.getincrementaldecoder(codec)('ignore')
+        for path in (args or ['-']):
+            if path == '-':
+                fp = sys.stdin
+            else:
+                fp = open(path, 'rb')
+            while 1:
+                data = os.read(fp.fileno(), bufsize)
+                if not data: break
+                yield decoder.decode(data)
+            if fp is not sys.stdin:
+                fp.close()
+        yield decoder.decode('', True)
+        return
+    synth.synth_pieces(writer, pieces())
     writer.close()
+    if debug:
+        print >>sys.stderr, synth.units
     return 0
 
 if __name__ == '__main__': sys.exit(main(sys.argv))
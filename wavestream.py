@@ -4,6 +4,10 @@ import wave
 import struct
 import array
 import subprocess
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 ##  WaveReader
@@ -117,8 +121,11 @@ class WaveWriter(object):
     
     def write(self, frames):
         assert self.nchannels == 1
-        a = [ int(x*self.ratio) for x in frames ]
-        a = array.array(self.arraytype, a)
+        if numpy is not None and isinstance(frames, numpy.ndarray):
+            a = (frames*self.ratio).astype(self.arraytype)
+        else:
+            a = [ int(x*self.ratio) for x in frames ]
+            a = array.array(self.arraytype, a)
         self.writeraw(a.tostring())
         return
 
@@ -139,6 +146,8 @@ class CommandWavePlayer(object):
             fmt = 'S16_LE'
             self.ratio = 32767.0
             self.arraytype = 'h'
+        self.nchannels = nchannels
+        self.sampwidth = sampwidth
         cmdline = player+('-c',str(nchannels),'-r',str(framerate),'-f',fmt)
         self._process = subprocess.Popen(cmdline, stdin=subprocess.PIPE)
         self._nframeswritten = 0
@@ -156,9 +165,17 @@ class CommandWavePlayer(object):
     def tell(self):
         return self._nframeswritten
 
+    def writeraw(self, bytes):
+        self._process.stdin.write(bytes)
+        self._nframeswritten += len(bytes) / (self.sampwidth*self.nchannels)
+        return
+
     def write(self, frames):
-        data = [ int(x*self.ratio) for x in frames ]
-        data = array.array(self.arraytype, data)
+        if numpy is not None and isinstance(frames, numpy.ndarray):
+            data = (frames*self.ratio).astype(self.arraytype)
+        else:
+            data = [ int(x*self.ratio) for x in frames ]
+            data = array.array(self.arraytype, data)
         self._process.stdin.write(data.tostring())
         self._nframeswritten += len(frames)
         return
@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import sys, re
+from pytcdb import LRUCache
 
 
 ##  utilities
@@ -12,16 +13,27 @@ def hira2kata(s):
 def decode_yomi(s):
     return u''.join( unichr(0x3000+ord(c)) for c in s )
 
-POSTMAP = { u'は':u'わ', u'へ':u'え' }
-POST = re.compile(ur'([はわ])([^ぁ-ん]*)$')
-EUPH = re.compile(ur'([オコゴソゾトドノホボポモヨロョォ])ウ')
+# reg_yomi: normalize a reading. The last hiragana of a reading is
+# read as わ if it is は, kana become katakana and ウ after an o-row
+# kana becomes ー. Every step is a translate or a substitution of a fixed
+# string, so no Python code runs per match.
+POST = re.compile(ur'は(?=[^ぁ-ん]*\Z)')
+EUPH = re.compile(ur'(?<=[おこごそぞとどのほぼぽもよろょぉオコゴソゾトドノホボポモヨロョォ])[うウ]')
 def reg_yomi(s):
-    def f(m):
-       return POSTMAP[m.group(1)]+m.group(2)
-    s = POST.sub(f, s)
-    s = hira2kata(s)
-    s = EUPH.sub(ur'\1ー', s)
-    return s
+    s = POST.sub(u'わ', s)
+    s = EUPH.sub(u'ー', s)
+    return hira2kata(s)
+
+# reg_yomis: normalize a list of readings at once, joined by a
+# character that no reading has.
+SEP = u'\uffff'
+POSTN = re.compile(ur'は(?=[^ぁ-ん\uffff]*(?:\uffff|\Z))')
+def reg_yomis(ss):
+    if len(ss) < 2 or any( SEP in s for s in ss ):
+        return [ reg_yomi(s) for s in ss ]
+    s = POSTN.sub(u'わ', SEP.join(ss))
+    s = EUPH.sub(u'ー', s)
+    return hira2kata(s).split(SEP)
 
 
 ##  Wakacher
@@ -51,6 +63,22 @@ class Wakacher(object):
     #for c in u')]〉》」』】〕）\］uff63':
     #    KIND[c] = 7
 
+    # KINDCODE: translates a line into a string of kinds, one digit
+    # per character. Characters of kind 0 are left as they are, which
+    # never turns them into a digit of another kind since all digits
+    # are of kind 5.
+    KINDCODE = dict( (ord(c), unicode(k)) for (c,k) in KIND.iteritems() )
+    RUN = {
+        u'0': re.compile(u'[^1-6]*'),
+        u'1': re.compile(u'[15]*'),
+        u'2': re.compile(u'2*'),
+        u'3': re.compile(u'3*'),
+        u'5': re.compile(u'5*'),
+        u'6': re.compile(u'6*'),
+        }
+    STATE = { u'1':'latin', u'2':'tail', u'3':'kata', u'4':'kanji',
+              u'5':'digit', u'6':'paren' }
+
     PREFIX1 = set(
         [u'お'
          ])
@@ -84,147 +112,136 @@ class Wakacher(object):
          u'連日',
          ])
 
+    # hiragana that need a look: prefixes and particles.
+    TAILSTOP = re.compile(u'[%s]' % u''.join(sorted(PREFIX1 | set(POST1))))
+
     MAXCONTKANJI = 2
 
     def __init__(self, tcdb, codec='euc-jp'):
         self._tcdb = tcdb
         self.codec = codec
-        self.reset()
-        return
-    
-    def reset(self):
-        self._chunks = []
-        self._chunk = u''
-        self._parse = self._parse_main
         return
 
-    def feed(self, chars):
-        i = 0
-        while 0 <= i and i < len(chars):
-            c = chars[i]
-            k = self.KIND.get(c, 0)
-            i = self._parse(c, k, i)
+    def set_tcdb(self, tcdb):
+        self._tcdb = tcdb
         return
 
     def get_chunks(self, chars):
-        self.reset()
-        self.feed(chars)
-        self._flush()
-        (r, self._chunks) = (self._chunks, [])
-        return r
-    
-    def _flush(self):
-        if self._chunk:
-            self._chunks.append(self._chunk)
-            self._chunk = u''
+        (chunks, _) = self._scan(chars)
+        return chunks
+
+    # iter_chunks: yields the chunks of a text given in pieces of any
+    # size, each as soon as it is complete. Only the unfinished chunk
+    # is carried over to the next piece.
+    def iter_chunks(self, pieces):
+        rest = u''
+        for piece in pieces:
+            chars = rest+piece
+            (chunks, a) = self._scan(chars, final=False)
+            for s in chunks:
+                yield s
+            rest = chars[a:]
+        (chunks, _) = self._scan(rest)
+        for s in chunks:
+            yield s
         return
-    
-    def _parse_main(self, c, k, i):
-        if k == 1:
-            self._parse = self._parse_latin
-        elif k == 2:
-            self._parse = self._parse_tail
-        elif k == 3:
-            self._parse = self._parse_kata
-        elif k == 4:
-            self._dstate = 0
-            self._parse = self._parse_kanji
-        elif k == 5:
-            self._parse = self._parse_digit
-        elif k == 6:
-            self._parse = self._parse_paren
-        else:
-            self._parse = self._parse_other
-        return i
 
-    def _parse_other(self, c, k, i):
-        if k == 0:
-            self._chunk += c
-            return i+1
-        self._flush()
-        self._parse = self._parse_main
-        return i
-
-    def _parse_tail(self, c, k, i):
-        if k == 2:
-            # 「お願い」などの「お」は直前で切る。
-            if c in self.PREFIX1:
-                self._prechunk = c
-                self._parse = self._parse_tailpre
-                return i+1
-            self._chunk += c
-            # 助詞がきたら切るかもしれない。
-            if c in self.POST1:
-                self._parse = self._parse_tail2
-            return i+1
-        self._parse = self._parse_other
-        return i
-
-    def _parse_tail2(self, c, k, i):
-        if k == 2:
-            # 助詞が続く場合。
-            c0 = self._chunk[-1]
-            if (c0 in self.POST1 and c in self.POST1[c0]):
-                self._parse = self._parse_tail
-                return i
-        # 助詞が終わったので切る。
-        self._parse = self._parse_other
-        return i
-
-    def _parse_tailpre(self, c, k, i):
-        if k == 4:
-            # 「お+漢字」は「お」の前で切る。
-            self._flush()
-            self._chunk += self._prechunk
-            self._dstate = 0
-            self._parse = self._parse_kanji
-            return i
-        self._chunk += self._prechunk
-        self._parse = self._parse_tail
-        return i
-
-    def _parse_latin(self, c, k, i):
-        if k == 1 or k == 5:
-            self._chunk += c
-            return i+1
-        self._parse = self._parse_tail
-        return i
-
-    def _parse_kata(self, c, k, i):
-        if k == 3:
-            self._chunk += c
-            return i+1
-        self._parse = self._parse_tail
-        return i
-        
-    def _parse_kanji(self, c, k, i):
-        if k == 4:
-            try:
-                (_, self._dstate) = self._tcdb.lookup1(c.encode(self.codec), self._dstate)
-            except KeyError:
-                self._dstate = 0
-                # MAXCONTKANJI 文字以上の漢字単語のあとは切る。
-                if self.MAXCONTKANJI <= len(self._chunk):
-                    self._parse = self._parse_other
-                    return i
-            self._chunk += c
-            return i+1
-        self._parse = self._parse_tail
-        return i
-    
-    def _parse_digit(self, c, k, i):
-        if k == 5:
-            self._chunk += c
-            return i+1
-        self._parse = self._parse_main
-        return i
-
-    def _parse_paren(self, c, k, i):
-        if k == 6:
-            self._chunk += c
-            return i+1
-        self._parse = self._parse_main
-        return i
+    # _scan: splits a string into chunks, run by run. The kinds of
+    # all characters are found at once, every run that stays in one
+    # state is skipped with a regexp and chunks are sliced out of the
+    # string. Only kanji are looked at one by one, as each of them
+    # needs a dictionary lookup.
+    # Returns (chunks, a) where a is the start of the unfinished chunk.
+    # Unless final, that chunk is left out: scanning again from there
+    # starts in the same state, as every chunk does.
+    def _scan(self, chars, final=True):
+        ks = chars.translate(self.KINDCODE)
+        n = len(chars)
+        chunks = []
+        (a, i, state) = (0, 0, 'main')
+        while i < n:
+            k = ks[i]
+            if k not in self.STATE:
+                k = u'0'
+            if state == 'main':
+                state = self.STATE.get(k, 'other')
+                dstate = 0
+            elif state == 'other':
+                if k == u'0':
+                    i = self.RUN[k].match(ks, i).end()
+                    continue
+                if a < i:
+                    chunks.append(chars[a:i])
+                a = i
+                state = 'main'
+            elif state == 'tail':
+                if k != u'2':
+                    state = 'other'
+                    continue
+                e = self.RUN[k].match(ks, i).end()
+                m = self.TAILSTOP.search(chars, i, e)
+                if m is None:
+                    i = e
+                    continue
+                i = m.start()
+                c = chars[i]
+                if c in self.PREFIX1:
+                    # 「お願い」などの「お」は直前で切る。
+                    if i+1 < n and ks[i+1] == u'4':
+                        if a < i:
+                            chunks.append(chars[a:i])
+                        a = i
+                        dstate = 0
+                        state = 'kanji'
+                    elif i+1 == n:
+                        if not final: break
+                        # a prefix at the very end is dropped.
+                        n = i
+                    i += 1
+                    continue
+                # 助詞がきたら、助詞が続かなければ切る。
+                i += 1
+                if not (i < n and ks[i] == u'2' and chars[i] in self.POST1[c]):
+                    state = 'other'
+            elif state == 'kanji':
+                if k != u'4':
+                    state = 'tail'
+                    continue
+                try:
+                    (_, dstate) = self._tcdb.lookup1(chars[i].encode(self.codec), dstate)
+                except KeyError:
+                    dstate = 0
+                    # MAXCONTKANJI 文字以上の漢字単語のあとは切る。
+                    if self.MAXCONTKANJI <= i-a:
+                        state = 'other'
+                        continue
+                i += 1
+            elif state == 'latin':
+                if k != u'1' and k != u'5':
+                    state = 'tail'
+                    continue
+                i = self.RUN[u'1'].match(ks, i).end()
+            elif state == 'kata':
+                if k != u'3':
+                    state = 'tail'
+                    continue
+                i = self.RUN[k].match(ks, i).end()
+            elif state == 'digit':
+                if k != u'5':
+                    state = 'main'
+                    continue
+                i = self.RUN[k].match(ks, i).end()
+            else:
+                # paren
+                if k != u'6':
+                    state = 'main'
+                    continue
+                i = self.RUN[k].match(ks, i).end()
+        if final:
+            if a < n:
+                chunks.append(chars[a:n])
+            a = n
+        return (chunks, a)
 
 
 ##  Yomer
@@ -314,12 +331,29 @@ class Yomer(object):
         'z': u'ゼット',
         }
     
-    def __init__(self, tcdb, codec='euc-jp'):
+    def __init__(self, tcdb, codec='euc-jp', cachesize=4096):
         self._tcdb = tcdb
         self.codec = codec
+        # cache: finished readings of recent chunks, keyed by the chunk.
+        # Its hits/misses/hitrate() tell how well it does.
+        self.cache = None
+        if cachesize:
+            self.cache = LRUCache(cachesize)
         self.reset()
         return
 
+    # set_tcdb: switch to another dictionary.
+    def set_tcdb(self, tcdb):
+        self._tcdb = tcdb
+        self.invalidate()
+        return
+
+    # invalidate: forget the cached readings.
+    def invalidate(self):
+        if self.cache is not None:
+            self.cache.clear()
+        return
+
     def reset(self):
         self._chunks = []
         self._part = u''
@@ -337,6 +371,22 @@ class Yomer(object):
         return
 
     def get_yomi(self, chars):
+        if self.cache is None:
+            return [self._get_yomi(chars)]
+        a = self.cache.get(chars)
+        if a is None:
+            a = tuple(self._get_yomi(chars))
+            self.cache.put(chars, a)
+        return [list(a)]
+
+    # iter_yomi: yields the readings of each chunk of an iterable.
+    def iter_yomi(self, chunks):
+        for s in chunks:
+            for a in self.get_yomi(s):
+                yield a
+        return
+
+    def _get_yomi(self, chars):
         self.reset()
         self.feed(chars)
         self._flush()
@@ -350,12 +400,12 @@ class Yomer(object):
                     x += c
             else:
                 if x:
-                    a.append((x, reg_yomi(x)))
+                    a.append(x)
                     x = u''
-                a.append((y, reg_yomi(y)))
+                a.append(y)
         if x:
-            a.append((x, reg_yomi(x)))
-        return [a]
+            a.append(x)
+        return zip(a, reg_yomis(a))
 
     def _flush(self):
         if self._yomi is not None:
@@ -408,7 +458,7 @@ class Yomer(object):
 # main
 def main(argv):
     import getopt, fileinput, os.path
-    from pycdb import TCDBReader
+    from pytcdb import TCDBReader, DATrieReader
     def usage():
         print 'usage: %s [-d] [-c codec] [-D dictpath] [file ...]' % argv[0]
         return 100
@@ -425,7 +475,10 @@ def main(argv):
         elif k == '-c': codec = v
         elif k == '-C': dictcodec = v
         elif k == '-D': dictpath = v
-    tcdb = TCDBReader(dictpath)
+    if dictpath.endswith('.dat'):
+        tcdb = DATrieReader(dictpath)
+    else:
+        tcdb = TCDBReader(dictpath)
     yomer = Yomer(tcdb, dictcodec)
     wakacher = Wakacher(tcdb, dictcodec)
     for line in fileinput.input(args):
@@ -435,6 +488,8 @@ def main(argv):
             for y in yomer.get_yomi(s):
                 t = u''.join( v or k for (k,v) in y)
                 print t
+    if debug:
+        print >>sys.stderr, yomer.cache
     return 0
 
 if __name__ == '__main__': sys.exit(main(sys.argv))